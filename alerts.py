@@ -0,0 +1,189 @@
+import os
+import threading
+import time
+
+from timetable import get_timetable
+
+# Service alerts indexed by the entities they inform.
+# The alerts feed is decoded once per feed version (header timestamp) into
+# plain dicts keeping every translation, then indexed by route_id, stop_id
+# and agency_id. Alerts informing a trip are filed under the trip's route;
+# alerts naming only an agency apply to all of that agency's routes. Route
+# and stop lookups are then dictionary reads plus an active period check.
+# Reference: https://gtfs.org/realtime/reference/#message-alert
+# Reference: https://gtfs.org/realtime/reference/#message-entityselector
+
+# How often the leader polls the alerts feed
+ALERTS_REFRESH_SECONDS = float(os.getenv("ALERTS_REFRESH_SECONDS", "60"))
+
+
+def _translations(translated_string):
+    return [
+        {"language": translation.language or None, "text": translation.text}
+        for translation in translated_string.translation
+    ]
+
+
+def decode_alerts(feed):
+    """
+    Decode the alerts of a FeedMessage into plain dicts.
+    """
+    alerts = []
+    if not feed:
+        return alerts
+    for entity in feed.entity:
+        if not entity.HasField("alert"):
+            continue
+        alert = entity.alert
+        header_text = _translations(alert.header_text)
+        description_text = _translations(alert.description_text)
+        alerts.append(
+            {
+                "alert_id": entity.id,
+                "cause": alert.cause,
+                "effect": alert.effect,
+                # First translation, as served before translations were kept
+                "header_text": header_text[0]["text"] if header_text else None,
+                "description_text": description_text[0]["text"] if description_text else None,
+                "translations": {
+                    "header_text": header_text,
+                    "description_text": description_text,
+                    "url": _translations(alert.url),
+                },
+                "active_period": [
+                    {"start": period.start or None, "end": period.end or None}
+                    for period in alert.active_period
+                ],
+                "informed_entity": [
+                    {
+                        "agency_id": informed.agency_id,
+                        "route_id": informed.route_id,
+                        "stop_id": informed.stop_id,
+                        "trip_id": informed.trip.trip_id if informed.HasField("trip") else "",
+                        "trip_route_id": informed.trip.route_id if informed.HasField("trip") else "",
+                    }
+                    for informed in alert.informed_entity
+                ],
+            }
+        )
+    return alerts
+
+
+def is_active(alert, now):
+    """
+    An alert without active periods is always active.
+    """
+    periods = alert["active_period"]
+    if not periods:
+        return True
+    return any(
+        (period["start"] is None or period["start"] <= now) and (period["end"] is None or now <= period["end"])
+        for period in periods
+    )
+
+
+class AlertIndex:
+    """
+    Holds the latest alerts and their route, stop and agency indexes,
+    rebuilt once per alerts feed version.
+    """
+
+    def __init__(self, timetable):
+        self.timetable = timetable
+        self.version = None
+        self.updated_at = None
+        self._alerts = []
+        self._by_route = {}
+        self._by_stop = {}
+        self._by_agency = {}
+        self._lock = threading.Lock()
+
+    def update(self, snapshot):
+        """
+        Index a published alerts snapshot ({"version", "timestamp", "alerts"}).
+        """
+        if snapshot["version"] == self.version:
+            return
+        tt = self.timetable
+        by_route, by_stop, by_agency = {}, {}, {}
+
+        def add(index, key, alert):
+            alerts = index.setdefault(key, [])
+            if not alerts or alerts[-1] is not alert:
+                alerts.append(alert)
+
+        for alert in snapshot["alerts"]:
+            for informed in alert["informed_entity"]:
+                route_id = informed["route_id"] or informed["trip_route_id"]
+                if not route_id and informed["trip_id"]:
+                    trip_idx = tt.trip_index.get(informed["trip_id"])
+                    if trip_idx is not None:
+                        route_id = str(tt.route_ids[tt.trip_route[trip_idx]])
+                if route_id:
+                    add(by_route, route_id, alert)
+                if informed["stop_id"]:
+                    add(by_stop, informed["stop_id"], alert)
+                if informed["agency_id"] and not (route_id or informed["stop_id"] or informed["trip_id"]):
+                    add(by_agency, informed["agency_id"], alert)
+
+        with self._lock:
+            self.version = snapshot["version"]
+            self.updated_at = snapshot["timestamp"]
+            self._alerts = snapshot["alerts"]
+            self._by_route = by_route
+            self._by_stop = by_stop
+            self._by_agency = by_agency
+
+    def _merge(self, *groups, now=None):
+        now = int(now if now is not None else time.time())
+        seen = set()
+        merged = []
+        for alerts in groups:
+            for alert in alerts:
+                if alert["alert_id"] not in seen and is_active(alert, now):
+                    seen.add(alert["alert_id"])
+                    merged.append(alert)
+        return merged
+
+    def all_alerts(self, now=None):
+        return self._merge(self._alerts, now=now)
+
+    def route_alerts(self, route_id, now=None):
+        """
+        Active alerts for a route, including alerts for its whole agency.
+        """
+        groups = [self._by_route.get(route_id, ())]
+        route_idx = self.timetable.route_index.get(route_id)
+        if route_idx is not None and self._by_agency:
+            agency_id = str(self.timetable.route_agency_ids[route_idx])
+            if agency_id:
+                groups.append(self._by_agency.get(agency_id, ()))
+            else:
+                # agency_id is optional in single-agency feeds
+                groups.extend(self._by_agency.values())
+        return self._merge(*groups, now=now)
+
+    def stop_alerts(self, stop_id, route_ids=(), now=None):
+        """
+        Active alerts for a stop, plus those of the given routes serving it.
+        """
+        groups = [self._by_stop.get(stop_id, ())]
+        for route_id in dict.fromkeys(route_ids):
+            groups.append(self.route_alerts(route_id, now=now))
+        return self._merge(*groups, now=now)
+
+
+_alert_index = None
+_alert_index_lock = threading.Lock()
+
+
+def get_alert_index():
+    """
+    Return the process-wide alert index, creating it on first use.
+    """
+    global _alert_index
+    if _alert_index is None:
+        with _alert_index_lock:
+            if _alert_index is None:
+                _alert_index = AlertIndex(get_timetable())
+    return _alert_index
@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+from snapshot import SNAPSHOT_DIR
+from timetable import format_seconds, get_feed_version, get_timetable
+
+# Scheduled service analytics computed from the in-memory timetable.
+# For a service date the stop times of all active trips are laid out as one
+# frame (route, direction, stop, departure) and every measure is a grouped
+# pandas operation over it: trip counts, first/last departure, span of
+# service, headways between consecutive departures and trips per hour.
+# Reports are cached per (feed version, date) and, when SNAPSHOT_DIR is set,
+# written next to the timetable snapshot so workers and restarts reuse them.
+# Reference: https://pandas.pydata.org/docs/user_guide/groupby.html
+
+ANALYTICS_CACHE_SIZE = int(os.getenv("ANALYTICS_CACHE_SIZE", "32"))
+
+ROUTE_KEYS = ["route_id", "direction_id"]
+STOP_KEYS = ["route_id", "direction_id", "stop_id"]
+
+
+def _summarize(frame, keys):
+    """
+    Per-group service measures of a frame of departures (seconds).
+    """
+    if frame.empty:
+        return []
+    frame = frame.sort_values(keys + ["departure"], kind="stable")
+    frame["headway"] = frame.groupby(keys, sort=False)["departure"].diff()
+    frame["hour"] = frame["departure"] // 3600
+
+    grouped = frame.groupby(keys, sort=True)
+    summary = grouped.agg(
+        trips=("departure", "size"),
+        first_departure=("departure", "min"),
+        last_departure=("departure", "max"),
+        headway_min=("headway", "min"),
+        headway_mean=("headway", "mean"),
+        headway_median=("headway", "median"),
+        headway_max=("headway", "max"),
+    )
+    # Trips per hour as {hour: count}; hours past 23 belong to the same service day
+    per_hour = frame.groupby(keys + ["hour"], sort=True).size()
+
+    rows = []
+    hourly = {}
+    for (*key, hour), count in per_hour.items():
+        hourly.setdefault(tuple(key), {})[int(hour)] = int(count)
+    for key, values in summary.iterrows():
+        key = key if isinstance(key, tuple) else (key,)
+        row = {name: (int(value) if name == "direction_id" else str(value)) for name, value in zip(keys, key)}
+        first, last = int(values["first_departure"]), int(values["last_departure"])
+        row.update(
+            {
+                "trips": int(values["trips"]),
+                "first_departure": format_seconds(first),
+                "last_departure": format_seconds(last),
+                "span_minutes": round((last - first) / 60, 1),
+                "headway_minutes": None
+                if np.isnan(values["headway_mean"])
+                else {
+                    "min": round(values["headway_min"] / 60, 1),
+                    "mean": round(values["headway_mean"] / 60, 1),
+                    "median": round(values["headway_median"] / 60, 1),
+                    "max": round(values["headway_max"] / 60, 1),
+                },
+                "trips_per_hour": hourly.get(key, {}),
+            }
+        )
+        rows.append(row)
+    return rows
+
+
+def service_report(timetable, service_date):
+    """
+    Service measures for a date, per route and direction (from trip start
+    times) and per route, direction and stop (from every stop time).
+    """
+    tt = timetable
+    trips = np.flatnonzero(tt.active_trip_mask(service_date))
+    first = tt.trip_stop_time_start[trips]
+    counts = tt.trip_stop_time_start[trips + 1] - first
+    trips, first, counts = trips[counts > 0], first[counts > 0], counts[counts > 0]
+
+    # Flat layout of the stop times of the active trips
+    group_start = np.cumsum(counts) - counts
+    stop_times = np.arange(counts.sum()) - np.repeat(group_start, counts) + np.repeat(first, counts)
+    owner = np.repeat(trips, counts)
+
+    stops = pd.DataFrame(
+        {
+            "route_id": tt.route_ids[tt.trip_route[owner]],
+            "direction_id": tt.trip_direction[owner],
+            "stop_id": tt.stop_ids[tt.stop_time_stop[stop_times]],
+            "departure": tt.stop_time_departure[stop_times].astype(np.int64),
+        }
+    )
+    routes = pd.DataFrame(
+        {
+            "route_id": tt.route_ids[tt.trip_route[trips]],
+            "direction_id": tt.trip_direction[trips],
+            "departure": tt.stop_time_departure[first].astype(np.int64),
+        }
+    )
+    return {
+        "date": service_date.isoformat(),
+        "routes": _summarize(routes, ROUTE_KEYS),
+        "stops": _summarize(stops, STOP_KEYS),
+    }
+
+
+def _report_path(version, service_date):
+    return os.path.join(SNAPSHOT_DIR, version, f"analytics.{service_date:%Y%m%d}.json")
+
+
+_reports = OrderedDict()
+_reports_lock = threading.Lock()
+
+
+def get_service_report(service_date):
+    """
+    Cached service report for a date under the current feed version.
+    """
+    version = get_feed_version()
+    key = (version, service_date)
+    with _reports_lock:
+        report = _reports.get(key)
+        if report is not None:
+            _reports.move_to_end(key)
+            return report
+
+    path = _report_path(version, service_date) if SNAPSHOT_DIR and version else None
+    if path and os.path.exists(path):
+        with open(path) as f:
+            report = json.load(f)
+    else:
+        report = service_report(get_timetable(), service_date)
+        report["feed_version"] = version
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = f"{path}.{os.getpid()}.tmp"
+            with open(temporary, "w") as f:
+                json.dump(report, f)
+            os.replace(temporary, path)
+
+    with _reports_lock:
+        _reports[key] = report
+        while len(_reports) > ANALYTICS_CACHE_SIZE:
+            _reports.popitem(last=False)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute service analytics for upcoming dates.")
+    parser.add_argument("--start", type=date.fromisoformat, default=date.today(), help="First date (YYYY-MM-DD)")
+    parser.add_argument("--days", type=int, default=7)
+    args = parser.parse_args()
+    if not SNAPSHOT_DIR:
+        parser.error("SNAPSHOT_DIR must be set to store precomputed reports")
+    if not get_feed_version():
+        parser.error("No feed version recorded; run load_feed_version.py first")
+
+    for offset in range(args.days):
+        service_date = args.start + timedelta(days=offset)
+        report = get_service_report(service_date)
+        print(f"{service_date}: {len(report['routes'])} route directions, {len(report['stops'])} route stops")
@@ -0,0 +1,260 @@
+import os
+import threading
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+from eta import service_day_epoch
+from shape_snap import MAX_SNAP_METERS, get_shape_index
+from timetable import get_timetable
+
+# Resolve which scheduled trip a vehicle is running.
+# Vehicles often report an empty or stale trip_id between trips. A bus
+# works through the trips of its block in order, so the active trips of a
+# service day are grouped by block_id and sorted by start time; once a
+# vehicle is placed in a block, following it to its next trip is a step
+# forward in that sorted run. Each vehicle's last assignment is cached, so
+# a steady-state tick is a dictionary read and a comparison. Vehicles with
+# no usable trip and no cached block are placed once by snapping their
+# position onto the shapes of the trips scheduled around that time.
+# Reference: https://gtfs.org/schedule/reference/#tripstxt (block_id)
+# Reference: https://gtfs.org/realtime/reference/#message-tripdescriptor
+
+# A vehicle may start its next trip this early...
+BLOCK_EARLY_SECONDS = int(os.getenv("BLOCK_EARLY_SECONDS", "600"))
+# ...and still be finishing a trip this long after its scheduled end
+BLOCK_LATE_SECONDS = int(os.getenv("BLOCK_LATE_SECONDS", "1800"))
+# Wait this long before retrying a vehicle that could not be placed
+BLOCK_RETRY_SECONDS = int(os.getenv("BLOCK_RETRY_SECONDS", "60"))
+# Service days kept built (today, yesterday and the day before a rollover)
+SERVICE_DAYS_CACHED = 3
+
+# Offsets closer than this are treated as equally good position matches
+POSITION_TOLERANCE_METERS = 25.0
+
+
+class ServiceDayBlocks:
+    """
+    Active trips of one service day, grouped by block and sorted by start.
+
+    Trips are laid out block after block; the run of block g is
+    group_start[g]:group_end[g]. Trips without a block_id are runs of one.
+    Start and end are seconds since the service day's midnight.
+    """
+
+    def __init__(self, timetable, service_date):
+        tt = timetable
+        self.service_date = service_date
+        self.midnight = service_day_epoch(service_date.strftime("%Y%m%d"))
+
+        trips = np.flatnonzero(tt.active_trip_mask(service_date))
+        first = tt.trip_stop_time_start[trips]
+        last = tt.trip_stop_time_start[trips + 1] - 1
+        keep = last >= first
+        trips, first, last = trips[keep], first[keep], last[keep]
+
+        start = tt.stop_time_departure[first].astype(np.int64)
+        end = tt.stop_time_arrival[last].astype(np.int64)
+        blocks = tt.trip_block_ids[trips]
+        order = np.lexsort((start, blocks))
+
+        self.trips = trips[order]
+        self.start = start[order]
+        self.end = end[order]
+        blocks = blocks[order]
+
+        boundaries = np.flatnonzero((blocks[1:] != blocks[:-1]) | (blocks[1:] == "")) + 1
+        self.group_start = np.concatenate(([0], boundaries)).astype(np.int64)
+        self.group_end = np.concatenate((boundaries, [len(self.trips)])).astype(np.int64)
+        self.group_of = np.repeat(np.arange(len(self.group_start)), self.group_end - self.group_start)
+        self.position = {int(trip): i for i, trip in enumerate(self.trips)}
+
+    def advance(self, position, seconds):
+        """
+        Move along the block to the trip running at seconds, or None when
+        the block's last trip ended.
+        """
+        end = self.group_end[self.group_of[position]]
+        while position + 1 < end and self.start[position + 1] - BLOCK_EARLY_SECONDS <= seconds:
+            position += 1
+        if seconds > self.end[position] + BLOCK_LATE_SECONDS:
+            return None
+        return position
+
+    def candidates(self, seconds):
+        """
+        Positions of the trips scheduled around seconds.
+        """
+        return np.flatnonzero(
+            (self.start - BLOCK_EARLY_SECONDS <= seconds) & (seconds <= self.end + BLOCK_LATE_SECONDS)
+        )
+
+
+class BlockResolver:
+    """
+    Assigns vehicles to trips, caching the last assignment per vehicle.
+    """
+
+    def __init__(self, timetable):
+        self.timetable = timetable
+        self._days = {}
+        self._assignments = {}
+        self._retry_after = {}
+        self._lock = threading.Lock()
+
+    def _service_day(self, service_date):
+        day = self._days.get(service_date)
+        if day is None:
+            with self._lock:
+                day = self._days.get(service_date)
+                if day is None:
+                    day = ServiceDayBlocks(self.timetable, service_date)
+                    self._days[service_date] = day
+                    for stale in sorted(self._days)[:-SERVICE_DAYS_CACHED]:
+                        del self._days[stale]
+        return day
+
+    def _service_days(self):
+        """
+        Today's and yesterday's blocks (trips past midnight belong to the
+        previous service day), built once per date. The date comes from the
+        wall clock, not from vehicle timestamps, so a vehicle reporting a
+        stale time cannot force a rebuild.
+        """
+        today = date.today()
+        return self._service_day(today), self._service_day(today - timedelta(days=1))
+
+    def resolve(self, vehicle_id, trip_id, latitude, longitude, timestamp=None):
+        """
+        Trip index the vehicle is running. When it cannot be placed, the
+        reported trip if the timetable knows it, otherwise None.
+        """
+        now = int(timestamp or time.time())
+        days = self._service_days()
+
+        # Reported trip: trusted until a later trip of its block is due, then
+        # treated as stale (vehicles often keep the last trip_id through a
+        # layover) and followed along the block
+        trip_idx = self.timetable.trip_index.get(trip_id) if trip_id else None
+        if trip_idx is not None:
+            for day in days:
+                position = day.position.get(trip_idx)
+                if position is None:
+                    continue
+                due = day.advance(position, now - day.midnight)
+                if due is None:
+                    continue
+                if due != position:
+                    due = self._settle(vehicle_id, day, position, due, latitude, longitude)
+                return self._assign(vehicle_id, day, due)
+
+        # Steady state: continue from the cached assignment
+        cached = self._assignments.get(vehicle_id)
+        if cached is not None:
+            day, position = cached
+            position = day.advance(position, now - day.midnight)
+            if position is not None:
+                return self._assign(vehicle_id, day, position)
+            del self._assignments[vehicle_id]
+
+        if self._retry_after.get(vehicle_id, 0) <= now:
+            placed = self._place(days, latitude, longitude, now)
+            if placed is not None:
+                return self._assign(vehicle_id, *placed)
+            self._retry_after[vehicle_id] = now + BLOCK_RETRY_SECONDS
+
+        # A known trip outside the active calendar (calendar_dates-only
+        # service, an expired calendar row): trust the feed
+        return trip_idx
+
+    def _assign(self, vehicle_id, day, position):
+        self._assignments[vehicle_id] = (day, position)
+        self._retry_after.pop(vehicle_id, None)
+        return int(day.trips[position])
+
+    def _settle(self, vehicle_id, day, reported, due, latitude, longitude):
+        """
+        Choose among the reported trip and the later trips of its block that
+        are due: the one whose shape passes closest to the vehicle, the latest
+        on ties unless the vehicle is still short of the end of the earliest
+        candidate's shape (running late rather than starting the next trip).
+        Never steps back behind the vehicle's cached trip.
+        """
+        cached = self._assignments.get(vehicle_id)
+        if cached is not None and cached[0] is day and reported <= cached[1] <= due:
+            reported = cached[1]
+        if reported == due or latitude is None or longitude is None:
+            return due
+
+        shape_index = get_shape_index()
+        positions = np.arange(reported, due + 1)
+        shapes = shape_index.trip_shape[day.trips[positions]]
+        _, _, along, offset = shape_index.snap(
+            shapes,
+            np.full(len(positions), latitude),
+            np.full(len(positions), longitude),
+        )
+        offset = np.nan_to_num(offset, nan=np.inf)
+        if not offset.min() <= MAX_SNAP_METERS:
+            return due
+
+        buckets = np.floor(offset / POSITION_TOLERANCE_METERS)
+        closest = np.flatnonzero(buckets == buckets.min())
+        choice = closest[-1]
+        if closest[0] == 0 and shapes[0] >= 0:
+            shape_end = shape_index.point_dist[shape_index.shape_point_start[shapes[0] + 1] - 1]
+            if along[0] < shape_end - POSITION_TOLERANCE_METERS:
+                choice = 0
+        return int(positions[choice])
+
+    def _place(self, days, latitude, longitude, now):
+        """
+        Pick the scheduled trip whose shape passes closest to the vehicle,
+        preferring trips whose scheduled window contains now.
+        """
+        if latitude is None or longitude is None:
+            return None
+        owners, positions, lateness = [], [], []
+        for i, day in enumerate(days):
+            seconds = now - day.midnight
+            candidates = day.candidates(seconds)
+            owners.append(np.full(len(candidates), i))
+            positions.append(candidates)
+            lateness.append(
+                np.maximum(day.start[candidates] - seconds, 0) + np.maximum(seconds - day.end[candidates], 0)
+            )
+        owners = np.concatenate(owners)
+        positions = np.concatenate(positions)
+        if len(positions) == 0:
+            return None
+        lateness = np.concatenate(lateness)
+
+        shape_index = get_shape_index()
+        trips = np.array([days[owner].trips[position] for owner, position in zip(owners, positions)], dtype=np.int64)
+        _, _, _, offset = shape_index.snap(
+            shape_index.trip_shape[trips],
+            np.full(len(trips), latitude),
+            np.full(len(trips), longitude),
+        )
+        matched = np.flatnonzero(offset <= MAX_SNAP_METERS)
+        if len(matched) == 0:
+            return None
+        best = matched[np.lexsort((lateness[matched], np.floor(offset[matched] / POSITION_TOLERANCE_METERS)))[0]]
+        return days[owners[best]], int(positions[best])
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_block_resolver():
+    """
+    Return the process-wide block resolver.
+    """
+    global _resolver
+    if _resolver is None:
+        with _resolver_lock:
+            if _resolver is None:
+                _resolver = BlockResolver(get_timetable())
+    return _resolver
@@ -4,4 +4,7 @@ from database import engine
 def create_tables():
   # Create all tables (if they don't exist)
   Base.metadata.create_all(bind=engine)
-  print("Tables created successfully.")
\ No newline at end of file
+  print("Tables created successfully.")
+
+if __name__ == "__main__":
+  create_tables()
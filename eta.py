@@ -0,0 +1,332 @@
+import os
+import threading
+import time
+from datetime import datetime, date
+
+import numpy as np
+
+from timetable import get_timetable
+
+# ETA prediction from GTFS-realtime trip updates and vehicle progress.
+# Every feed tick the remaining stop times of all active trips are laid out
+# as one flat array, explicit delays are scattered into it and carried
+# forward within each trip, and the resulting predictions are cached per
+# (trip, stop) and per stop so arrival boards are plain lookups.
+# Reference: https://gtfs.org/realtime/reference/#message-stoptimeupdate
+# Reference: https://gtfs.org/realtime/feed-entities/trip-updates/#stop-time-updates
+
+# How often the background task rebuilds predictions
+ETA_REFRESH_SECONDS = float(os.getenv("ETA_REFRESH_SECONDS", "15"))
+
+# Predictions this far in the past are dropped (bus just left)
+PAST_GRACE_SECONDS = 60
+
+
+# TripDescriptor / StopTimeUpdate schedule relationships we act on
+TRIP_CANCELED = 3
+STOP_SKIPPED = 1
+STOP_NO_DATA = 2
+
+
+def decode_trip_updates(feed):
+    """
+    Decode the trip updates of a FeedMessage into plain dicts.
+    """
+    trip_updates = []
+    if not feed:
+        return trip_updates
+    for entity in feed.entity:
+        if not entity.HasField("trip_update"):
+            continue
+        trip_update = entity.trip_update
+        updates = []
+        for update in trip_update.stop_time_update:
+            event = update.arrival if update.HasField("arrival") else update.departure
+            has_event = update.HasField("arrival") or update.HasField("departure")
+            updates.append(
+                {
+                    "stop_id": update.stop_id,
+                    "stop_sequence": update.stop_sequence if update.HasField("stop_sequence") else None,
+                    # Which event time/delay describe (the arrival unless only a departure is given)
+                    "event": "arrival" if update.HasField("arrival") or not has_event else "departure",
+                    "time": event.time if has_event and event.time else None,
+                    "delay": event.delay if has_event and event.HasField("delay") else None,
+                    "schedule_relationship": update.schedule_relationship,
+                }
+            )
+        trip_updates.append(
+            {
+                "trip_id": trip_update.trip.trip_id,
+                "start_time": trip_update.trip.start_time,
+                "start_date": trip_update.trip.start_date,
+                "schedule_relationship": trip_update.trip.schedule_relationship,
+                "updates": updates,
+            }
+        )
+    return trip_updates
+
+
+def service_day_epoch(start_date):
+    """
+    Epoch seconds of local midnight for a GTFS service date (YYYYMMDD),
+    falling back to today when the feed does not say.
+    """
+    if start_date:
+        service_date = datetime.strptime(start_date, "%Y%m%d").date()
+    else:
+        service_date = date.today()
+    return int(time.mktime(service_date.timetuple()))
+
+
+class EtaEngine:
+    """
+    Holds the latest predictions, rebuilt in one batch per feed tick.
+    """
+
+    def __init__(self, timetable):
+        self.timetable = timetable
+        self._by_trip = {}
+        self._by_stop = {}
+        self._canceled = frozenset()
+        self._active_trips = (None, None)
+        self.updated_at = None
+        self._lock = threading.Lock()
+
+    def update(self, trip_updates, vehicles=(), now=None):
+        """
+        Recompute predictions for every trip with realtime data.
+
+        vehicles are snapped positions (see shape_snap.snap_vehicles); their
+        next_stop_sequence marks the stops a trip has already passed.
+        """
+        tt = self.timetable
+        now = int(now if now is not None else time.time())
+
+        progress = {
+            vehicle["trip_id"]: vehicle["next_stop_sequence"]
+            for vehicle in vehicles
+            if vehicle.get("next_stop_sequence") is not None
+        }
+
+        trips = []
+        day_epochs = []
+        trip_updates_kept = []
+        canceled = set()
+        for trip_update in trip_updates:
+            if trip_update["schedule_relationship"] == TRIP_CANCELED:
+                canceled.add(trip_update["trip_id"])
+                continue
+            trip_idx = tt.trip_index.get(trip_update["trip_id"])
+            if trip_idx is None or tt.trip_stop_time_start[trip_idx + 1] == tt.trip_stop_time_start[trip_idx]:
+                continue
+            trips.append(trip_idx)
+            day_epochs.append(service_day_epoch(trip_update["start_date"]))
+            trip_updates_kept.append(trip_update)
+
+        if not trips:
+            self._publish({}, {}, canceled, now)
+            return
+
+        # Flat layout of all stop times of all active trips
+        trips = np.asarray(trips, dtype=np.int64)
+        first = tt.trip_stop_time_start[trips]
+        counts = tt.trip_stop_time_start[trips + 1] - first
+        group_start = np.cumsum(counts) - counts
+        stop_time = np.arange(counts.sum()) - np.repeat(group_start, counts) + np.repeat(first, counts)
+        scheduled = tt.stop_time_arrival[stop_time].astype(np.int64) + np.repeat(day_epochs, counts)
+        scheduled_departure = tt.stop_time_departure[stop_time].astype(np.int64) + np.repeat(day_epochs, counts)
+
+        observed = np.full(len(stop_time), np.nan)
+        skipped = np.zeros(len(stop_time), dtype=bool)
+        remaining_from = np.zeros(len(trips), dtype=np.int64)
+
+        for group, trip_update in enumerate(trip_updates_kept):
+            start, count = group_start[group], counts[group]
+            sequences = tt.stop_time_sequence[first[group]:first[group] + count]
+            stops = tt.stop_time_stop[first[group]:first[group] + count]
+            for update in trip_update["updates"]:
+                position = self._locate(sequences, stops, update)
+                if position is None:
+                    continue
+                if update["schedule_relationship"] == STOP_SKIPPED:
+                    skipped[start + position] = True
+                elif update["schedule_relationship"] == STOP_NO_DATA:
+                    continue
+                elif update["time"]:
+                    # A departure time is compared with the scheduled departure,
+                    # otherwise the dwell would be counted as delay
+                    if update.get("event") == "departure":
+                        observed[start + position] = update["time"] - scheduled_departure[start + position]
+                    else:
+                        observed[start + position] = update["time"] - scheduled[start + position]
+                elif update["delay"] is not None:
+                    observed[start + position] = update["delay"]
+
+            next_sequence = progress.get(trip_update["trip_id"])
+            if next_sequence is not None:
+                remaining_from[group] = np.searchsorted(sequences, next_sequence)
+
+        # Carry each observed delay forward to the following stops of its trip
+        has_observation = ~np.isnan(observed)
+        source = np.where(has_observation, np.arange(len(observed)), -1)
+        source[group_start] = group_start
+        source = np.maximum.accumulate(source)
+        delay = np.nan_to_num(observed[source], nan=0.0).astype(np.int64)
+        predicted = scheduled + delay
+
+        owner = np.repeat(np.arange(len(trips)), counts)
+        position_in_trip = np.arange(len(stop_time)) - np.repeat(group_start, counts)
+        keep = (
+            ~skipped
+            & (position_in_trip >= remaining_from[owner])
+            & (predicted >= now - PAST_GRACE_SECONDS)
+        )
+        keep = np.flatnonzero(keep)
+
+        # Materialise the cache: per trip in stop order, per stop soonest first
+        by_trip = {}
+        predictions = {}
+        for i in keep.tolist():
+            trip_idx = trips[owner[i]]
+            route_idx = tt.trip_route[trip_idx]
+            stop_id = str(tt.stop_ids[tt.stop_time_stop[stop_time[i]]])
+            trip_id = str(tt.trip_ids[trip_idx])
+            prediction = {
+                "trip_id": trip_id,
+                "route_id": str(tt.route_ids[route_idx]),
+                "route_short_name": str(tt.route_short_names[route_idx]),
+                "trip_headsign": str(tt.trip_headsigns[trip_idx]),
+                "stop_id": stop_id,
+                "stop_sequence": int(tt.stop_time_sequence[stop_time[i]]),
+                "scheduled_arrival": int(scheduled[i]),
+                "predicted_arrival": int(predicted[i]),
+                "scheduled_departure": int(scheduled_departure[i]),
+                "predicted_departure": int(scheduled_departure[i] + delay[i]),
+                "delay": int(delay[i]),
+                "source": "realtime" if has_observation[i] else "propagated",
+            }
+            predictions[i] = prediction
+            trip = by_trip.get(trip_id)
+            if trip is None:
+                trip_update = trip_updates_kept[owner[i]]
+                trip = by_trip[trip_id] = {
+                    "trip_id": trip_id,
+                    "route_id": prediction["route_id"],
+                    "start_time": trip_update.get("start_time") or None,
+                    "start_date": trip_update["start_date"] or None,
+                    "stop_time_updates": [],
+                }
+            trip["stop_time_updates"].append(prediction)
+
+        by_stop = {}
+        for i in keep[np.lexsort((predicted[keep], tt.stop_time_stop[stop_time[keep]]))].tolist():
+            by_stop.setdefault(predictions[i]["stop_id"], []).append(predictions[i])
+
+        self._publish(by_trip, by_stop, canceled, now)
+
+    def _locate(self, sequences, stops, update):
+        """
+        Position of a stop time update within its trip (by sequence, else stop).
+        """
+        if update["stop_sequence"] is not None:
+            position = int(np.searchsorted(sequences, update["stop_sequence"]))
+            if position < len(sequences) and sequences[position] == update["stop_sequence"]:
+                return position
+            return None
+        stop_idx = self.timetable.stop_index.get(update["stop_id"])
+        if stop_idx is None:
+            return None
+        matches = np.flatnonzero(stops == stop_idx)
+        return int(matches[0]) if len(matches) else None
+
+    def _publish(self, by_trip, by_stop, canceled, now):
+        with self._lock:
+            self._by_trip = by_trip
+            self._by_stop = by_stop
+            self._canceled = frozenset(canceled)
+            self.updated_at = now
+
+    def arrivals(self, stop_id, limit=None, now=None):
+        """
+        Upcoming arrivals at a stop, soonest first: cached predictions, plus
+        today's scheduled departures of trips without realtime data.
+        """
+        now = int(now if now is not None else time.time())
+        predictions = self._by_stop.get(stop_id, [])
+        arrivals = predictions + self._scheduled(stop_id, now, limit)
+        arrivals.sort(key=lambda arrival: arrival["predicted_arrival"])
+        return arrivals[:limit] if limit else arrivals
+
+    def _active_trip_mask(self, service_date):
+        cached_date, mask = self._active_trips
+        if cached_date != service_date:
+            mask = self.timetable.active_trip_mask(service_date)
+            self._active_trips = (service_date, mask)
+        return mask
+
+    def _scheduled(self, stop_id, now, limit):
+        """
+        Scheduled departures from a stop after now, read from the timetable's
+        per-stop index, skipping trips with realtime data or canceled.
+        """
+        tt = self.timetable
+        stop_idx = tt.stop_index.get(stop_id)
+        if stop_idx is None:
+            return []
+        service_date = date.fromtimestamp(now)
+        midnight = service_day_epoch(service_date.strftime("%Y%m%d"))
+        positions = tt.stop_departures(stop_idx)
+        first = int(np.searchsorted(tt.stop_time_departure[positions], now - midnight - PAST_GRACE_SECONDS))
+        positions = positions[first:]
+        positions = positions[self._active_trip_mask(service_date)[tt.stop_time_trip[positions]]]
+
+        scheduled = []
+        for stop_time in positions.tolist():
+            trip_idx = tt.stop_time_trip[stop_time]
+            trip_id = str(tt.trip_ids[trip_idx])
+            if trip_id in self._by_trip or trip_id in self._canceled:
+                continue
+            route_idx = tt.trip_route[trip_idx]
+            arrival = midnight + int(tt.stop_time_arrival[stop_time])
+            departure = midnight + int(tt.stop_time_departure[stop_time])
+            scheduled.append(
+                {
+                    "trip_id": trip_id,
+                    "route_id": str(tt.route_ids[route_idx]),
+                    "route_short_name": str(tt.route_short_names[route_idx]),
+                    "trip_headsign": str(tt.trip_headsigns[trip_idx]),
+                    "stop_id": stop_id,
+                    "stop_sequence": int(tt.stop_time_sequence[stop_time]),
+                    "scheduled_arrival": arrival,
+                    "predicted_arrival": arrival,
+                    "scheduled_departure": departure,
+                    "predicted_departure": departure,
+                    "delay": None,
+                    "source": "scheduled",
+                }
+            )
+            if limit and len(scheduled) >= limit:
+                break
+        return scheduled
+
+    def trips(self):
+        """
+        Cached predictions of every trip with realtime data, in stop order.
+        """
+        return list(self._by_trip.values())
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_eta_engine():
+    """
+    Return the process-wide ETA engine.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = EtaEngine(get_timetable())
+    return _engine
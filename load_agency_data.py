@@ -3,6 +3,7 @@ from sqlalchemy.orm import Session
 from database import engine
 from models import Agency
 from create_tables import create_tables
+from load_feed_version import clear_feed_version
 from envConfig import GTFS_ROOT_FILE_PATH
 
 # Reference: https://dnmtechs.com/loading-csv-file-into-database-using-sqlalchemy-in-python-3/
@@ -38,4 +39,5 @@ def load_agency_data():
 
 if __name__ == "__main__":
   create_tables()
+  clear_feed_version()
   load_agency_data()
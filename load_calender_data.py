@@ -4,6 +4,7 @@ from models import Calendar
 from database import engine
 from datetime import datetime
 from create_tables import create_tables
+from load_feed_version import clear_feed_version
 from envConfig import GTFS_ROOT_FILE_PATH
 
 # Reference: https://dnmtechs.com/loading-csv-file-into-database-using-sqlalchemy-in-python-3/
@@ -61,4 +62,5 @@ def load_calendar_data():
 
 if __name__ == "__main__":
   create_tables()
+  clear_feed_version()
   load_calendar_data()
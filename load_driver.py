@@ -0,0 +1,175 @@
+import argparse
+import asyncio
+import os
+import resource
+import statistics
+import sys
+import time
+
+import websockets
+
+# WebSocket fan-out load driver.
+# Opens many /ws/bus-positions connections against a running server (usually
+# fed by replay_server.py) and reports delivery latency, bytes per client and
+# the server's CPU usage over the run.
+# Latency is measured from the "timestamp" the poller stamps on each
+# positions snapshot to the moment a client receives it.
+# Reference: https://websockets.readthedocs.io/en/stable/reference/asyncio/client.html
+# Reference: https://man7.org/linux/man-pages/man5/proc.5.html
+
+TIMESTAMP_KEY = '"timestamp": '
+
+
+def message_timestamp(message):
+    """
+    Extract the snapshot timestamp without parsing the whole payload.
+    """
+    position = message.rfind(TIMESTAMP_KEY)
+    if position < 0:
+        return None
+    end = position + len(TIMESTAMP_KEY)
+    while end < len(message) and message[end] not in ",}":
+        end += 1
+    try:
+        return float(message[position + len(TIMESTAMP_KEY):end])
+    except ValueError:
+        return None
+
+
+def process_cpu_seconds(pid):
+    """
+    CPU seconds used by a process and all of its children (uvicorn workers).
+    """
+    ticks = os.sysconf("SC_CLK_TCK")
+    pids = {pid}
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                parents[int(entry)] = (int(fields[1]), int(fields[11]) + int(fields[12]))
+            except (OSError, IndexError, ValueError):
+                continue
+    # Walk the process tree below pid
+    changed = True
+    while changed:
+        changed = False
+        for child, (parent, _) in parents.items():
+            if parent in pids and child not in pids:
+                pids.add(child)
+                changed = True
+    return sum(parents[p][1] for p in pids if p in parents) / ticks
+
+
+async def run_client(url, deadline, stats):
+    try:
+        async with websockets.connect(url, max_size=None, open_timeout=30) as websocket:
+            stats["connected"] += 1
+            received = 0
+            first = True
+            while time.time() < deadline:
+                try:
+                    message = await asyncio.wait_for(websocket.recv(), timeout=deadline - time.time())
+                except asyncio.TimeoutError:
+                    break
+                now = time.time()
+                received += len(message)
+                stats["messages"] += 1
+                # The first message is whatever snapshot was current at connect time
+                sent_at = message_timestamp(message)
+                if sent_at is not None and not first:
+                    stats["latencies"].append(now - sent_at)
+                first = False
+            stats["bytes_per_client"].append(received)
+    except Exception as e:
+        stats["failed"] += 1
+        stats["errors"].setdefault(type(e).__name__, 0)
+        stats["errors"][type(e).__name__] += 1
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def drive(args):
+    stats = {
+        "connected": 0,
+        "failed": 0,
+        "messages": 0,
+        "latencies": [],
+        "bytes_per_client": [],
+        "errors": {},
+    }
+    started = time.time()
+    deadline = started + args.ramp + args.duration
+    cpu_before = process_cpu_seconds(args.server_pid) if args.server_pid else None
+
+    tasks = []
+    for i in range(args.clients):
+        tasks.append(asyncio.create_task(run_client(args.url, deadline, stats)))
+        # Spread connection attempts evenly over the ramp-up period
+        if args.ramp > 0:
+            await asyncio.sleep(args.ramp / args.clients)
+    await asyncio.gather(*tasks)
+
+    elapsed = time.time() - started
+    latencies = stats["latencies"]
+    bytes_per_client = stats["bytes_per_client"]
+    print(f"clients:            {args.clients} requested, {stats['connected']} connected, {stats['failed']} failed")
+    if stats["errors"]:
+        print(f"errors:             {stats['errors']}")
+    print(f"messages received:  {stats['messages']}")
+    if latencies:
+        print(
+            "fan-out latency:    p50 {:.3f}s  p95 {:.3f}s  p99 {:.3f}s  max {:.3f}s".format(
+                percentile(latencies, 0.50),
+                percentile(latencies, 0.95),
+                percentile(latencies, 0.99),
+                max(latencies),
+            )
+        )
+    if bytes_per_client:
+        print(
+            "bytes per client:   mean {:.0f}  max {}  ({:.0f} B/s per client)".format(
+                statistics.mean(bytes_per_client),
+                max(bytes_per_client),
+                statistics.mean(bytes_per_client) / elapsed,
+            )
+        )
+    if cpu_before is not None:
+        cpu = process_cpu_seconds(args.server_pid) - cpu_before
+        print(f"server CPU:         {cpu:.1f}s over {elapsed:.1f}s ({100 * cpu / elapsed:.0f}% of one core)")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the bus positions WebSocket fan-out.")
+    parser.add_argument("--url", default="ws://127.0.0.1:8000/ws/bus-positions")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds to stay connected after ramp-up")
+    parser.add_argument("--ramp", type=float, default=10.0, help="Seconds over which to open connections")
+    parser.add_argument("--server-pid", type=int, help="uvicorn master pid, to report server CPU")
+    args = parser.parse_args()
+
+    # Thousands of sockets need more than the default descriptor limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    stats = asyncio.run(drive(args))
+    # A run without deliveries measured nothing: usually the server published
+    # no positions (vehicles not matched to trips) or no client connected
+    if not stats["connected"]:
+        sys.exit("error: no client connected")
+    if not stats["messages"]:
+        sys.exit("error: no messages received; is the server publishing vehicle positions?")
+    if not stats["latencies"]:
+        sys.exit("error: no snapshot arrived after connect, so fan-out latency was not measured")
+
+
+if __name__ == "__main__":
+    main()
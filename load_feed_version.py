@@ -0,0 +1,62 @@
+import glob
+import hashlib
+import os
+
+import pandas as pd
+from sqlalchemy.orm import Session
+from models import FeedVersion
+from database import engine
+from create_tables import create_tables
+from envConfig import GTFS_ROOT_FILE_PATH
+
+# Records the version of the static feed once it is loaded. Derived caches
+# (timetable snapshot, tiles, analytics) are keyed by this value, so it is a
+# hash of the GTFS files' contents, prefixed with feed_info.txt's
+# feed_version when the feed publishes one.
+# Each load script clears the recorded version, so a partially re-imported
+# feed has no version (and no cached data) until this script runs last.
+# Reference: https://gtfs.org/schedule/reference/#feed_infotxt
+
+def feed_content_hash():
+  digest = hashlib.sha1()
+  for path in sorted(glob.glob(os.path.join(GTFS_ROOT_FILE_PATH, '*.txt'))):
+    digest.update(os.path.basename(path).encode())
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''):
+        digest.update(chunk)
+  return digest.hexdigest()[:12]
+
+def published_feed_version():
+  path = os.path.join(GTFS_ROOT_FILE_PATH, 'feed_info.txt')
+  if not os.path.exists(path):
+    return None
+  df = pd.read_csv(path, dtype=str)
+  if 'feed_version' not in df.columns or df.empty or pd.isna(df['feed_version'].iloc[0]):
+    return None
+  return df['feed_version'].iloc[0].strip()
+
+def clear_feed_version():
+  with Session(engine) as session:
+    session.query(FeedVersion).delete()
+    session.commit()
+
+def load_feed_version():
+  try:
+    version = feed_content_hash()
+    published = published_feed_version()
+    if published:
+      version = f"{published}-{version}"
+
+    with Session(engine) as session:
+      session.query(FeedVersion).delete()
+      session.add(FeedVersion(id=1, version=version))
+      session.commit()
+
+    print(f"Feed version {version} recorded successfully.")
+
+  except Exception as e:
+    print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+  create_tables()
+  load_feed_version()
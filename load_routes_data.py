@@ -4,6 +4,7 @@ from sqlalchemy.exc import SQLAlchemyError
 from database import engine
 from models import Route
 from create_tables import create_tables
+from load_feed_version import clear_feed_version
 from envConfig import GTFS_ROOT_FILE_PATH
 
 # Reference: https://dnmtechs.com/loading-csv-file-into-database-using-sqlalchemy-in-python-3/
@@ -47,4 +48,5 @@ def load_routes_data():
 
 if __name__ == "__main__":
   create_tables()
+  clear_feed_version()
   load_routes_data()
@@ -3,6 +3,7 @@ from sqlalchemy.orm import Session
 from models import StopTime
 from database import engine
 from create_tables import create_tables
+from load_feed_version import clear_feed_version
 from envConfig import GTFS_ROOT_FILE_PATH
 
 # Reference: https://dnmtechs.com/loading-csv-file-into-database-using-sqlalchemy-in-python-3/
@@ -40,4 +41,5 @@ def load_stop_times_data():
 
 if __name__ == "__main__":
   create_tables()
+  clear_feed_version()
   load_stop_times_data()
@@ -3,6 +3,7 @@ from sqlalchemy.orm import Session
 from models import Stop
 from database import engine
 from create_tables import create_tables
+from load_feed_version import clear_feed_version
 from envConfig import GTFS_ROOT_FILE_PATH
 
 # Reference: https://dnmtechs.com/loading-csv-file-into-database-using-sqlalchemy-in-python-3/
@@ -44,4 +45,5 @@ def load_stops_data():
 
 if __name__ == "__main__":
   create_tables()
+  clear_feed_version()
   load_stops_data()
@@ -1,8 +1,8 @@
 import logging
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, Response
 from sqlalchemy.orm import Session
 from database import engine, SessionLocal
-from models import Base, Route, Stop, Shape, Trip, StopTime, Calendar
+from models import Route, Stop, Shape, Trip, StopTime, Calendar
 from gtfs_realtime_pb2 import FeedMessage  # For parsing GTFS-realtime data
 import requests
 import json
@@ -15,6 +15,25 @@ from envConfig import (
 )
 import traceback
 from datetime import date
+from profiler import PROFILING_ENABLED, install_profiler, get_profile
+from raptor import plan_journey, get_executor, shutdown_executor
+from timetable import get_timetable, parse_seconds
+from shape_snap import snap_vehicles, get_shape_index
+from block_resolver import get_block_resolver
+from eta import get_eta_engine, decode_trip_updates, ETA_REFRESH_SECONDS
+from alerts import get_alert_index, decode_alerts, ALERTS_REFRESH_SECONDS
+from realtime_state import (
+    get_state_backend,
+    close_state_backend,
+    POSITIONS_POLL_SECONDS,
+    REALTIME_TICK_SECONDS,
+    REALTIME_FETCH_TIMEOUT_SECONDS,
+)
+from position_history import get_position_recorder, shutdown_position_recorder, PositionHistory, POSITION_HISTORY_DIR
+from vector_tiles import get_tile_renderer, MAX_ZOOM
+from analytics import get_service_report
+import time
+from datetime import datetime
 
 # Set up logging for debugging and tracking application behavior
 logging.basicConfig(level=logging.INFO)
@@ -34,8 +53,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Create database tables from models
-Base.metadata.create_all(bind=engine)
+# Opt-in per-request query profiling (PROFILE_REQUESTS=1)
+if PROFILING_ENABLED:
+    install_profiler(app, engine)
 
 # Dependency for managing database sessions
 # Ensures each request uses a clean session
@@ -54,6 +74,20 @@ connected_clients = set()
 async def root():
     return {"message": "Hello World"}
 
+# Endpoint to retrieve the query profile recorded for a request
+@app.get("/debug/profile/{request_id}")
+def get_request_profile(request_id: str):
+    """
+    Return the statements, timings and N+1 candidates recorded for a request.
+    The id is returned in the X-Profile-Id header of every profiled response.
+    """
+    if not PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+    profile = get_profile(request_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile.to_dict()
+
 # Endpoint to retrieve all routes
 @app.get("/routes")
 def get_routes(db: Session = Depends(get_db)):
@@ -172,14 +206,18 @@ def get_all_routes_details(db: Session = Depends(get_db)):
 # URL: https://github.com/MobilityData/gtfs-realtime-bindings/blob/master/python/README.md
 async def load_pb_from_url(url):
     """
-    Load GTFS-realtime data from the specified URL.
+    Load GTFS-realtime data from the specified URL. The blocking request
+    and parsing run in a thread so a slow upstream never stalls the loop.
     """
-    try:
-        response = requests.get(url)
+    def fetch():
+        response = requests.get(url, timeout=REALTIME_FETCH_TIMEOUT_SECONDS)
         response.raise_for_status()
         feed = FeedMessage()
         feed.ParseFromString(response.content)
         return feed
+
+    try:
+        return await asyncio.to_thread(fetch)
     except Exception as e:
         logger.error(f"Error loading data from URL {url}: {e}")
         logger.debug(traceback.format_exc())
@@ -188,9 +226,11 @@ async def load_pb_from_url(url):
 # Function to fetch and process bus positions
 # Reference: Parsing vehicle position updates in GTFS-realtime
 # URL: https://github.com/MobilityData/gtfs-realtime-bindings/blob/master/python/README.md
-async def fetch_bus_positions(db: Session):
+async def fetch_bus_positions():
     """
-    Fetch real-time bus positions from GTFS-realtime feed and associate them with routes.
+    Fetch real-time bus positions from GTFS-realtime feed, resolve their trips
+    (following the vehicle's block when the reported trip is empty or stale),
+    associate them with routes and snap them onto their trip shapes.
     """
     try:
         url = GTFS_REAL_TIME_POSITION_UPDATES_URL
@@ -200,126 +240,240 @@ async def fetch_bus_positions(db: Session):
         if not feed:
             return {"positions": []}
 
+        tt = get_timetable()
+        resolver = get_block_resolver()
+        vehicles = []
         for entity in feed.entity:
             if entity.HasField("vehicle"):
-                vehicle_id = entity.vehicle.vehicle.id
-                trip_id = entity.vehicle.trip.trip_id
-                latitude = entity.vehicle.position.latitude
-                longitude = entity.vehicle.position.longitude
-                bearing = entity.vehicle.position.bearing
-
-                # Fetch route details for the trip
-                trip = db.query(Trip).filter(Trip.trip_id == trip_id).first()
-                if trip:
-                    route = db.query(Route).filter(Route.route_id == trip.route_id).first()
-                    if route:
-                        positions.append(
-                            {
-                                "vehicle_id": vehicle_id,
-                                "latitude": latitude,
-                                "longitude": longitude,
-                                "bearing": bearing,
-                                "route_id": route.route_id,
-                                "route_short_name": route.route_short_name,
-                                "route_color": route.route_color,
-                            }
-                        )
+                # Resolve the trip from the in-memory timetable; vehicles with
+                # an empty or stale trip_id are followed along their block
+                reported_trip_id = entity.vehicle.trip.trip_id
+                trip_index = resolver.resolve(
+                    entity.vehicle.vehicle.id or entity.id,
+                    reported_trip_id,
+                    entity.vehicle.position.latitude if entity.vehicle.HasField("position") else None,
+                    entity.vehicle.position.longitude if entity.vehicle.HasField("position") else None,
+                    entity.vehicle.timestamp or None,
+                )
+                if trip_index is None:
+                    continue
+                trip_id = str(tt.trip_ids[trip_index])
+                vehicles.append(
+                    {
+                        "vehicle_id": entity.vehicle.vehicle.id,
+                        "trip_id": trip_id,
+                        "trip_inferred": trip_id != reported_trip_id,
+                        "trip_index": trip_index,
+                        "latitude": entity.vehicle.position.latitude,
+                        "longitude": entity.vehicle.position.longitude,
+                        "bearing": entity.vehicle.position.bearing,
+                    }
+                )
+
+        # Snap every vehicle onto its trip shape in one batch
+        snap_vehicles(vehicles)
+
+        for vehicle in vehicles:
+            route_index = tt.trip_route[vehicle.pop("trip_index")]
+            vehicle["route_id"] = str(tt.route_ids[route_index])
+            vehicle["route_short_name"] = str(tt.route_short_names[route_index])
+            vehicle["route_color"] = str(tt.route_colors[route_index]) or None
+            positions.append(vehicle)
         return {"positions": positions}
     except Exception as e:
         logger.error(f"Error fetching real-time positions: {e}")
         return {"positions": []}
 
+# Load the in-memory timetable and shapes (memory-mapped from the snapshot when present)
+def warm_static_caches():
+    started = time.perf_counter()
+    try:
+        get_timetable()
+        get_shape_index()
+        logger.info(f"Static caches ready in {time.perf_counter() - started:.3f}s")
+    except Exception as e:
+        logger.error(f"Error loading static caches: {e}")
+        logger.debug(traceback.format_exc())
+
+# Latest realtime snapshots seen by this worker, keyed by channel: (version, payload)
+realtime_snapshots = {}
+# Notified when a new positions snapshot lands; WebSocket clients wait on it
+positions_changed = asyncio.Condition()
+
+
+def positions_version():
+    snapshot = realtime_snapshots.get("positions")
+    return snapshot[0] if snapshot is not None else None
+
+# Leader side: poll the upstream feeds and publish decoded snapshots
+async def publish_realtime_snapshots(backend, poll_state):
+    """
+    Fetch the upstream feeds when due and publish them for all workers.
+    Positions are only published when at least one vehicle moved.
+    """
+    now = time.monotonic()
+    if now - poll_state["positions_polled_at"] >= POSITIONS_POLL_SECONDS:
+        poll_state["positions_polled_at"] = now
+        bus_positions = await fetch_bus_positions()
+
+        # Compare positions rounded to 6 decimal places to avoid minor floating-point differences
+        current_positions = {
+            bus["vehicle_id"]: (round(bus["latitude"], 6), round(bus["longitude"], 6))
+            for bus in bus_positions["positions"]
+        }
+        previous_positions = poll_state["previous_positions"]
+        if any(previous_positions.get(vehicle_id) != position for vehicle_id, position in current_positions.items()):
+            bus_positions["timestamp"] = time.time()
+            await asyncio.to_thread(backend.publish, "positions", json.dumps(bus_positions).encode())
+
+            # Keep a history of every published tick (enqueue only, never blocks)
+            recorder = get_position_recorder()
+            if recorder is not None:
+                recorder.record(bus_positions["positions"], bus_positions["timestamp"])
+        poll_state["previous_positions"] = current_positions
+
+    if now - poll_state["trip_updates_polled_at"] >= ETA_REFRESH_SECONDS:
+        poll_state["trip_updates_polled_at"] = now
+        feed = await load_pb_from_url(GTFS_REAL_TIME_TRIP_UPDATES_URL)
+        if feed:
+            trip_updates = decode_trip_updates(feed)
+            await asyncio.to_thread(backend.publish, "trip_updates", json.dumps(trip_updates).encode())
+
+    if now - poll_state["alerts_polled_at"] >= ALERTS_REFRESH_SECONDS:
+        poll_state["alerts_polled_at"] = now
+        feed = await load_pb_from_url(GTFS_REAL_TIME_ALERTS_URL)
+        if feed:
+            # Decode and publish only when the feed version changes
+            version = feed.header.timestamp or hash(feed.SerializeToString())
+            if version != poll_state["alerts_version"]:
+                alerts = {"version": version, "timestamp": feed.header.timestamp or None, "alerts": decode_alerts(feed)}
+                await asyncio.to_thread(backend.publish, "alerts", json.dumps(alerts).encode())
+                poll_state["alerts_version"] = version
+
+# Every worker: pick up new snapshots and refresh local caches
+async def consume_realtime_snapshots(backend):
+    """
+    Load snapshots published since the last tick, rebuild ETA predictions
+    when new trip updates arrive and re-index alerts when they change.
+    """
+    changed = set()
+    for channel in ("positions", "trip_updates", "alerts"):
+        snapshot = await asyncio.to_thread(backend.latest, channel)
+        if snapshot is None:
+            continue
+        current = realtime_snapshots.get(channel)
+        if current is None or current[0] != snapshot[0]:
+            realtime_snapshots[channel] = (snapshot[0], snapshot[1].decode())
+            changed.add(channel)
+
+    if "trip_updates" in changed:
+        positions = realtime_snapshots.get("positions")
+        vehicles = json.loads(positions[1])["positions"] if positions else []
+        await asyncio.to_thread(
+            get_eta_engine().update,
+            json.loads(realtime_snapshots["trip_updates"][1]),
+            vehicles,
+        )
+
+    if "alerts" in changed:
+        await asyncio.to_thread(get_alert_index().update, json.loads(realtime_snapshots["alerts"][1]))
+
+    if "positions" in changed:
+        async with positions_changed:
+            positions_changed.notify_all()
+
+# Background task driving realtime processing in this worker
+async def realtime_loop():
+    """
+    Only the worker holding the leader lease polls the feeds; every worker
+    consumes the published snapshots, so upstream traffic does not grow with
+    the number of uvicorn workers.
+    """
+    backend = get_state_backend()
+    poll_state = {
+        "positions_polled_at": float("-inf"),
+        "trip_updates_polled_at": float("-inf"),
+        "alerts_polled_at": float("-inf"),
+        "alerts_version": None,
+        "previous_positions": {},
+    }
+    while True:
+        try:
+            if await asyncio.to_thread(backend.try_acquire_leadership):
+                await publish_realtime_snapshots(backend, poll_state)
+            await consume_realtime_snapshots(backend)
+        except Exception as e:
+            logger.error(f"Error processing realtime feeds: {e}")
+            logger.debug(traceback.format_exc())
+        await asyncio.sleep(REALTIME_TICK_SECONDS)
+
 # WebSocket endpoint to stream real-time bus positions
 # Reference: FastAPI WebSocket usage
 # URL: https://fastapi.tiangolo.com/advanced/websockets/
 @app.websocket("/ws/bus-positions")
-async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)):
+async def websocket_endpoint(websocket: WebSocket):
     """
     Provide real-time bus positions through a WebSocket connection.
+    Each client is sent the shared positions snapshot whenever it changes,
+    woken by the realtime loop rather than polling.
     """
     await websocket.accept()
     connected_clients.add(websocket)
     logger.info("Client connected")
 
-    previous_positions = {}  # Keyed by vehicle_id
-
-    def positions_are_different(pos1, pos2):
-        lat1, lon1 = pos1
-        lat2, lon2 = pos2
-        # Compare positions rounded to 6 decimal places to avoid minor floating-point differences
-        return round(lat1, 6) != round(lat2, 6) or round(lon1, 6) != round(lon2, 6)
-
+    last_version = None
     try:
         while True:
-            # Fetch the latest positions and send to client
-            bus_positions = await fetch_bus_positions(db)
-            if bus_positions:
-                positions_changed = False
-                current_positions = {}
-
-                for bus in bus_positions["positions"]:
-                    vehicle_id = bus["vehicle_id"]
-                    current_position = (bus["latitude"], bus["longitude"])
-                    previous_position = previous_positions.get(vehicle_id)
-
-                    # Check if positions are different
-                    if previous_position is None or positions_are_different(
-                        previous_position, current_position
-                    ):
-                        positions_changed = True
-                        # Update current_positions
-                        current_positions[vehicle_id] = current_position
-                    else:
-                        # No change, keep previous position
-                        current_positions[vehicle_id] = previous_position
-
-                # Send to front end only if there are any changes
-                if positions_changed:
-                    message = json.dumps(bus_positions)
-                    await websocket.send_text(message)
-
-                # Update previous_positions
-                previous_positions = current_positions
-
-            await asyncio.sleep(2)  # Send updates every 2 seconds
+            snapshot = realtime_snapshots.get("positions")
+            if snapshot is not None and snapshot[0] != last_version:
+                await websocket.send_text(snapshot[1])
+                last_version = snapshot[0]
+            async with positions_changed:
+                await positions_changed.wait_for(lambda: positions_version() != last_version)
     except WebSocketDisconnect:
         logger.info("Client disconnected")
-        connected_clients.remove(websocket)
+        connected_clients.discard(websocket)
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
-        connected_clients.remove(websocket)
+        connected_clients.discard(websocket)
+
+# Background start-up work, run without holding up readiness: build the router
+# and fork the planner pool, then start realtime processing. Forking first
+# keeps the feed fetch and history recorder threads out of the planner
+# processes.
+async def start_background_work():
+    try:
+        await asyncio.to_thread(get_executor)
+    except Exception as e:
+        logger.error(f"Error starting the planner pool: {e}")
+    await realtime_loop()
+
+# Startup handler to start background realtime processing
+@app.on_event("startup")
+async def on_startup():
+    # Schema creation is a separate deploy step (python create_tables.py);
+    # here we only map the timetable snapshot so the first request is fast
+    await asyncio.to_thread(warm_static_caches)
+    asyncio.create_task(start_background_work())
 
 # Shutdown handler to close WebSocket connections gracefully
 @app.on_event("shutdown")
 async def on_shutdown():
-    for client in connected_clients:
+    for client in list(connected_clients):
         await client.close()
+    close_state_backend()
+    await asyncio.to_thread(shutdown_executor)
+    # Write the queued history ticks before the process exits
+    await asyncio.to_thread(shutdown_position_recorder)
 
 
+# Realtime trip updates, served from the ETA cache: every remaining stop of
+# a trip is listed, with delays carried forward from the last explicit update
 @app.get("/real-time-trips")
 def get_real_time_trips():
     try:
-        url = GTFS_REAL_TIME_TRIP_UPDATES_URL
-        feed = load_pb_from_url(url)
-        trips = [
-            {
-                "trip_id": entity.trip_update.trip.trip_id,
-                "route_id": entity.trip_update.trip.route_id,
-                "start_time": entity.trip_update.trip.start_time,
-                "start_date": entity.trip_update.trip.start_date,
-                "stop_time_updates": [
-                    {
-                        "stop_id": update.stop_id,
-                        "arrival": update.arrival.time if update.HasField("arrival") else None,
-                        "departure": update.departure.time if update.HasField("departure") else None,
-                    }
-                    for update in entity.trip_update.stop_time_update
-                ],
-            }
-            for entity in feed.entity
-            if entity.HasField("trip_update")
-        ]
-        return {"trips": trips}
+        engine_eta = get_eta_engine()
+        return {"updated_at": engine_eta.updated_at, "trips": engine_eta.trips()}
     except Exception as e:
         logger.error(f"Error fetching real-time trips: {e}")
         logger.debug(traceback.format_exc())
@@ -327,45 +481,49 @@ def get_real_time_trips():
 
 
 # Real-time Alerts Endpoint
+# Alerts are decoded once per feed version by the realtime loop; these
+# endpoints only read the pre-built indexes.
 @app.get("/real-time-alerts")
 def get_real_time_alerts():
     try:
-        url = GTFS_REAL_TIME_ALERTS_URL
-        feed = load_pb_from_url(url)
-        alerts = [
-            {
-                "alert_id": entity.id,
-                "cause": entity.alert.cause,
-                "effect": entity.alert.effect,
-                "header_text": entity.alert.header_text.translation[0].text
-                if entity.alert.header_text.translation
-                else None,
-                "description_text": entity.alert.description_text.translation[0].text
-                if entity.alert.description_text.translation
-                else None,
-                "informed_entity": [
-                    {
-                        "agency_id": informed.agency_id,
-                        "route_id": informed.route_id,
-                        "stop_id": informed.stop_id,
-                    }
-                    for informed in entity.alert.informed_entity
-                ],
-            }
-            for entity in feed.entity
-            if entity.HasField("alert")
-        ]
-        return {"alerts": alerts}
+        return {"alerts": get_alert_index().all_alerts()}
     except Exception as e:
         logger.error(f"Error fetching real-time alerts: {e}")
         logger.debug(traceback.format_exc())
         return {"error": "Failed to retrieve real-time alerts"}
 
 
+@app.get("/routes/{route_id}/alerts")
+def get_route_alerts(route_id: str):
+    """
+    Active alerts informing a route, a trip on it or its whole agency.
+    """
+    alert_index = get_alert_index()
+    return {
+        "route_id": route_id,
+        "updated_at": alert_index.updated_at,
+        "alerts": alert_index.route_alerts(route_id),
+    }
+
+
+@app.get("/stops/{stop_id}/alerts")
+def get_stop_alerts(stop_id: str):
+    """
+    Active alerts informing a stop.
+    """
+    alert_index = get_alert_index()
+    return {
+        "stop_id": stop_id,
+        "updated_at": alert_index.updated_at,
+        "alerts": alert_index.stop_alerts(stop_id),
+    }
+
+
 @app.get("/routes/{route_id}/schedule")
 def get_route_schedule(route_id: str, db: Session = Depends(get_db)):
     try:
         service_date = date.today()
+        alerts = get_alert_index().route_alerts(route_id)
 
         # Get weekday name in lowercase (e.g., 'monday', 'tuesday')
         weekday = service_date.strftime("%A").lower()
@@ -382,7 +540,7 @@ def get_route_schedule(route_id: str, db: Session = Depends(get_db)):
         )
 
         if not active_services:
-            return {"schedule": [], "message": "No active services today."}
+            return {"schedule": [], "alerts": alerts, "message": "No active services today."}
 
         service_ids = [service.service_id for service in active_services]
 
@@ -394,7 +552,7 @@ def get_route_schedule(route_id: str, db: Session = Depends(get_db)):
         )
 
         if not trips:
-            return {"schedule": [], "message": "No trips found for this route today."}
+            return {"schedule": [], "alerts": alerts, "message": "No trips found for this route today."}
 
         trip_ids = [trip.trip_id for trip in trips]
 
@@ -436,9 +594,163 @@ def get_route_schedule(route_id: str, db: Session = Depends(get_db)):
                 )
             schedule.append(trip_schedule)
 
-        return {"schedule": schedule}
+        return {"schedule": schedule, "alerts": alerts}
 
     except Exception as e:
         print(f"Error fetching schedule for route {route_id}: {e}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail="Failed to retrieve schedule")
+
+
+# Journey planning endpoint backed by the in-memory RAPTOR router
+# Reference: https://fastapi.tiangolo.com/async/#very-technical-details
+@app.get("/plan")
+async def plan_trip(
+    from_stop: str = None,
+    to_stop: str = None,
+    from_lat: float = None,
+    from_lon: float = None,
+    to_lat: float = None,
+    to_lon: float = None,
+    depart_at: str = None,
+    max_transfers: int = 4,
+):
+    """
+    Plan a journey between two stops or two coordinates, departing now
+    (or at depart_at, HH:MM[:SS]) on today's service.
+    """
+    if from_stop:
+        origin = from_stop
+    elif from_lat is not None and from_lon is not None:
+        origin = (from_lat, from_lon)
+    else:
+        raise HTTPException(status_code=400, detail="Provide from_stop or from_lat/from_lon")
+
+    if to_stop:
+        destination = to_stop
+    elif to_lat is not None and to_lon is not None:
+        destination = (to_lat, to_lon)
+    else:
+        raise HTTPException(status_code=400, detail="Provide to_stop or to_lat/to_lon")
+
+    try:
+        depart_seconds = parse_seconds(depart_at or datetime.now().strftime("%H:%M:%S"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="depart_at must be HH:MM[:SS]")
+
+    try:
+        loop = asyncio.get_running_loop()
+        # The pool may still be starting: wait for it off the event loop
+        executor = await asyncio.to_thread(get_executor)
+        journeys = await loop.run_in_executor(
+            executor,
+            plan_journey,
+            origin,
+            destination,
+            depart_seconds,
+            date.today(),
+            max_transfers + 1,
+        )
+        return {"journeys": journeys}
+    except Exception as e:
+        logger.error(f"Error planning journey: {e}")
+        logger.debug(traceback.format_exc())
+        raise HTTPException(status_code=500, detail="Failed to plan journey")
+
+
+# Predicted arrivals at a stop, served from the ETA cache
+@app.get("/stops/{stop_id}/arrivals")
+def get_stop_arrivals(stop_id: str, limit: int = 10):
+    """
+    Upcoming arrivals at a stop, soonest first. Predictions are rebuilt in
+    the background each feed tick and trips without realtime data come from
+    the timetable's per-stop index, so this is a cache lookup.
+    """
+    engine_eta = get_eta_engine()
+    arrivals = engine_eta.arrivals(stop_id, limit)
+    return {
+        "stop_id": stop_id,
+        "updated_at": engine_eta.updated_at,
+        "arrivals": arrivals,
+        # Alerts for the stop and for the routes arriving at it
+        "alerts": get_alert_index().stop_alerts(stop_id, [arrival["route_id"] for arrival in arrivals]),
+    }
+
+
+# Scheduled service analytics, computed from the in-memory timetable
+@app.get("/analytics/service")
+def get_service_analytics(service_date: date = None, route_id: str = None, stop_id: str = None):
+    """
+    Headways, trips per hour, first/last departure and span of service per
+    route and direction, and per stop, for a service date (default today).
+    Reports are cached per feed version and date.
+    """
+    try:
+        report = get_service_report(service_date or date.today())
+        routes = report["routes"]
+        stops = report["stops"]
+        if route_id is not None:
+            routes = [row for row in routes if row["route_id"] == route_id]
+            stops = [row for row in stops if row["route_id"] == route_id]
+        if stop_id is not None:
+            stops = [row for row in stops if row["stop_id"] == stop_id]
+        return {
+            "date": report["date"],
+            "feed_version": report["feed_version"],
+            "routes": routes,
+            "stops": stops,
+        }
+    except Exception as e:
+        logger.error(f"Error computing service analytics: {e}")
+        logger.debug(traceback.format_exc())
+        raise HTTPException(status_code=500, detail="Failed to compute service analytics")
+
+
+# Recorded vehicle position history
+@app.get("/history/vehicles/{vehicle_id}")
+def get_vehicle_history(vehicle_id: str, start: int = None, end: int = None):
+    """
+    Recorded track of a vehicle between start and end (epoch seconds,
+    defaulting to the last hour).
+    """
+    if POSITION_HISTORY_DIR is None:
+        raise HTTPException(status_code=404, detail="Position history is disabled")
+    end = end if end is not None else int(time.time())
+    start = start if start is not None else end - 3600
+    return {"vehicle_id": vehicle_id, "track": PositionHistory().vehicle_track(vehicle_id, start, end)}
+
+
+@app.get("/history/positions")
+def get_positions_history(start: int, end: int, limit: int = 10000):
+    """
+    All recorded vehicle positions between start and end (epoch seconds).
+    """
+    if POSITION_HISTORY_DIR is None:
+        raise HTTPException(status_code=404, detail="Position history is disabled")
+    return {"positions": PositionHistory().positions(start, end, limit)}
+
+
+# Vector tiles with stops and route shapes
+# Reference: https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+@app.get("/tiles/{z}/{x}/{y}.mvt")
+def get_tile(z: int, x: int, y: int):
+    """
+    Mapbox vector tile with a "shapes" layer (colored by route) and, from
+    zoom 13, a "stops" layer. Tiles are cached per feed version.
+    """
+    if not 0 <= z <= MAX_ZOOM or not 0 <= x < (1 << z) or not 0 <= y < (1 << z):
+        raise HTTPException(status_code=404, detail="Tile out of range")
+    try:
+        renderer = get_tile_renderer()
+        tile = renderer.tile(z, x, y)
+    except Exception as e:
+        logger.error(f"Error rendering tile {z}/{x}/{y}: {e}")
+        logger.debug(traceback.format_exc())
+        raise HTTPException(status_code=500, detail="Failed to render tile")
+    # Without a recorded feed version a re-import cannot be told apart, so
+    # clients must not keep the tile
+    if renderer.version is None:
+        headers = {"Cache-Control": "no-cache"}
+    else:
+        headers = {"Cache-Control": "public, max-age=86400", "ETag": f'"{renderer.version}-{z}-{x}-{y}"'}
+    return Response(content=tile, media_type="application/vnd.mapbox-vector-tile", headers=headers)
@@ -122,6 +122,15 @@ class Calendar(Base):
     service_name = Column(String, nullable=True)
     eta_schedule_id = Column(String, nullable=True)
 
+
+# Define the FeedVersion model recording which static feed is loaded
+# (a single row, written by load_feed_version.py after the other loaders)
+class FeedVersion(Base):
+    __tablename__ = 'feed_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(String, nullable=False)  # feed_info.txt feed_version plus a content hash
+
 # References
 # https://docs.sqlalchemy.org/en/20/orm/quickstart.html
 # https://docs.sqlalchemy.org/en/20/orm/basic_relationships.html
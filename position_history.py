@@ -0,0 +1,352 @@
+import fcntl
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+import envConfig  # noqa: F401  (loads .env into os.environ)
+
+# Append-only history of decoded vehicle positions.
+# Each UTC day gets its own directory holding one file per column, each a
+# flat array of fixed-width values (timestamp.u4, vehicle.u4, ...), plus two
+# dictionaries (vehicle ids, trip ids) with one id per line; the vehicle and
+# trip columns store the line number instead of the id. Records are appended
+# in time order, so readers memory-map the timestamp column alone to binary
+# search a window and the vehicle column alone to filter it.
+# Whichever worker holds the realtime lease records, so writers take a lock
+# on the day and re-read dictionaries another writer has extended. A tick is
+# appended one column at a time; if a write is cut short (disk full, killed
+# process) the next writer truncates every column back to the records
+# complete in all of them before appending, so columns never drift apart.
+# Set POSITION_HISTORY_DIR to enable recording.
+# Reference: https://numpy.org/doc/stable/reference/generated/numpy.memmap.html
+# Reference: https://numpy.org/doc/stable/user/basics.rec.html
+POSITION_HISTORY_DIR = os.getenv("POSITION_HISTORY_DIR")
+POSITION_HISTORY_QUEUE_SIZE = int(os.getenv("POSITION_HISTORY_QUEUE_SIZE", "1000"))
+
+COLUMNS = {
+    "timestamp": np.dtype("<u4"),
+    "vehicle": np.dtype("<u4"),
+    "trip": np.dtype("<u4"),
+    "latitude": np.dtype("<f4"),
+    "longitude": np.dtype("<f4"),
+    "bearing": np.dtype("<f4"),
+}
+
+# Records scanned per step when filtering a window by vehicle
+SCAN_CHUNK_RECORDS = 1 << 20
+
+logger = logging.getLogger(__name__)
+
+
+def day_key(timestamp):
+    return time.strftime("%Y%m%d", time.gmtime(timestamp))
+
+
+def _column_path(day_dir, name):
+    return os.path.join(day_dir, f"{name}.{COLUMNS[name].str[1:]}")
+
+
+class _Dictionary:
+    """
+    Append-only string dictionary backed by a text file (index = line number).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.values = []
+        self.index = {}
+        self.size = 0
+        self.refresh()
+
+    def refresh(self):
+        """
+        Re-read the file when another writer has appended to it.
+        """
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if size != self.size:
+            with open(self.path, encoding="utf-8") as f:
+                self.values = f.read().splitlines()
+            self.size = size
+            self.index = {value: i for i, value in enumerate(self.values)}
+
+    def encode(self, value, pending):
+        code = self.index.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.index[value] = code
+            pending.append(value)
+        return code
+
+    def repair(self):
+        """
+        Drop a trailing partial line left by an interrupted append.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def append(self, pending):
+        if pending:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(value + "\n" for value in pending))
+            self.size = os.path.getsize(self.path)
+
+
+class PositionRecorder:
+    """
+    Background writer. record() only enqueues, so the realtime loop never
+    waits on disk; when the queue is full the tick is dropped and counted.
+    """
+
+    _STOP = object()
+
+    def __init__(self, directory=POSITION_HISTORY_DIR, queue_size=POSITION_HISTORY_QUEUE_SIZE):
+        self.directory = directory
+        self.dropped_ticks = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._dictionaries = {}
+        self._thread = threading.Thread(target=self._run, name="position-recorder", daemon=True)
+        self._thread.start()
+
+    def record(self, positions, timestamp=None):
+        try:
+            self._queue.put_nowait((int(timestamp or time.time()), positions))
+        except queue.Full:
+            self.dropped_ticks += 1
+
+    def close(self, timeout=None):
+        """
+        Write the ticks still queued, then stop the writer thread.
+        """
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            timestamp, positions = item
+            try:
+                self._write(timestamp, positions)
+            except Exception as e:
+                logger.error(f"Error recording vehicle positions: {e}")
+
+    def _day_dictionaries(self, day):
+        dictionaries = self._dictionaries.get(day)
+        if dictionaries is None:
+            day_dir = os.path.join(self.directory, day)
+            os.makedirs(day_dir, exist_ok=True)
+            dictionaries = (
+                _Dictionary(os.path.join(day_dir, "vehicles.txt")),
+                _Dictionary(os.path.join(day_dir, "trips.txt")),
+            )
+            # Only the current day is ever appended to
+            self._dictionaries = {day: dictionaries}
+        return dictionaries
+
+    def _write(self, timestamp, positions):
+        if not positions:
+            return
+        day = day_key(timestamp)
+        day_dir = os.path.join(self.directory, day)
+        vehicles, trips = self._day_dictionaries(day)
+
+        # Another worker may have recorded while it held the lease: lock the
+        # day and pick up its dictionary entries before assigning codes
+        with open(os.path.join(day_dir, "write.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                vehicles.repair()
+                trips.repair()
+                vehicles.refresh()
+                trips.refresh()
+                _truncate_columns(day_dir)
+                new_vehicles, new_trips = [], []
+                columns = {
+                    "timestamp": np.full(len(positions), timestamp),
+                    "vehicle": [vehicles.encode(p["vehicle_id"], new_vehicles) for p in positions],
+                    "trip": [trips.encode(p.get("trip_id") or "", new_trips) for p in positions],
+                    "latitude": [p["latitude"] for p in positions],
+                    "longitude": [p["longitude"] for p in positions],
+                    "bearing": [p.get("bearing") or 0.0 for p in positions],
+                }
+
+                # Dictionary entries are written before the records referencing them
+                vehicles.append(new_vehicles)
+                trips.append(new_trips)
+                for name, values in columns.items():
+                    with open(_column_path(day_dir, name), "ab") as f:
+                        f.write(np.asarray(values, dtype=COLUMNS[name]).tobytes())
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _truncate_columns(day_dir):
+    """
+    Cut every column to the number of records complete in all of them,
+    undoing the tail of an interrupted append.
+    """
+    paths = {name: _column_path(day_dir, name) for name in COLUMNS}
+    sizes = {name: os.path.getsize(path) if os.path.exists(path) else 0 for name, path in paths.items()}
+    count = min(sizes[name] // COLUMNS[name].itemsize for name in COLUMNS)
+    for name, path in paths.items():
+        if sizes[name] != count * COLUMNS[name].itemsize:
+            logger.warning(f"Truncating {path} to {count} records after an interrupted append")
+            with open(path, "rb+") as f:
+                f.truncate(count * COLUMNS[name].itemsize)
+
+
+class PositionHistory:
+    """
+    Read side: memory-mapped queries over the recorded days.
+    """
+
+    def __init__(self, directory=POSITION_HISTORY_DIR):
+        self.directory = directory
+        self._dictionary_cache = {}
+
+    def _dictionaries(self, day):
+        """
+        Vehicle and trip dictionaries of a day, re-read only when they grow.
+        """
+        day_dir = os.path.join(self.directory, day)
+        paths = (os.path.join(day_dir, "vehicles.txt"), os.path.join(day_dir, "trips.txt"))
+        sizes = tuple(os.path.getsize(path) if os.path.exists(path) else 0 for path in paths)
+        cached = self._dictionary_cache.get(day)
+        if cached is None or cached[0] != sizes:
+            cached = (sizes, tuple(_Dictionary(path) for path in paths))
+            self._dictionary_cache[day] = cached
+        return cached[1]
+
+    def _days(self, start, end):
+        day = datetime.fromtimestamp(start, tz=timezone.utc).date()
+        last = datetime.fromtimestamp(end, tz=timezone.utc).date()
+        while day <= last:
+            yield day.strftime("%Y%m%d")
+            day += timedelta(days=1)
+
+    def _columns(self, day):
+        """
+        Memory-mapped columns of a day, cut to the records complete in every
+        column (a tick may be partially appended while we read).
+        """
+        day_dir = os.path.join(self.directory, day)
+        paths = {name: _column_path(day_dir, name) for name in COLUMNS}
+        if not all(os.path.exists(path) for path in paths.values()):
+            return None
+        count = min(os.path.getsize(path) // COLUMNS[name].itemsize for name, path in paths.items())
+        if count == 0:
+            return None
+        return {
+            name: np.memmap(path, dtype=COLUMNS[name], mode="r", shape=(count,))
+            for name, path in paths.items()
+        }
+
+    def _window(self, columns, start, end):
+        timestamps = columns["timestamp"]
+        return (
+            int(np.searchsorted(timestamps, start, side="left")),
+            int(np.searchsorted(timestamps, end, side="right")),
+        )
+
+    def _decode(self, day, columns, rows):
+        """
+        Decode the records at rows (a slice or an index array).
+        """
+        vehicles, trips = (dictionary.values for dictionary in self._dictionaries(day))
+        values = {name: np.asarray(column[rows]).tolist() for name, column in columns.items()}
+        return [
+            {
+                "timestamp": timestamp,
+                "vehicle_id": vehicles[vehicle],
+                "trip_id": trips[trip] or None,
+                "latitude": latitude,
+                "longitude": longitude,
+                "bearing": bearing,
+            }
+            for timestamp, vehicle, trip, latitude, longitude, bearing in zip(
+                values["timestamp"],
+                values["vehicle"],
+                values["trip"],
+                values["latitude"],
+                values["longitude"],
+                values["bearing"],
+            )
+        ]
+
+    def positions(self, start, end, limit=None):
+        """
+        All recorded positions in [start, end] (epoch seconds), oldest first.
+        """
+        results = []
+        for day in self._days(start, end):
+            columns = self._columns(day)
+            if columns is None:
+                continue
+            first, last = self._window(columns, start, end)
+            if limit is not None:
+                last = min(last, first + limit - len(results))
+            results.extend(self._decode(day, columns, slice(first, last)))
+            if limit is not None and len(results) >= limit:
+                break
+        return results
+
+    def vehicle_track(self, vehicle_id, start, end):
+        """
+        Positions of one vehicle in [start, end]. Only the vehicle column is
+        scanned, in fixed-size chunks so memory use does not grow with the day.
+        """
+        track = []
+        for day in self._days(start, end):
+            columns = self._columns(day)
+            if columns is None:
+                continue
+            code = self._dictionaries(day)[0].index.get(vehicle_id)
+            if code is None:
+                continue
+            first, last = self._window(columns, start, end)
+            for chunk_start in range(first, last, SCAN_CHUNK_RECORDS):
+                chunk = columns["vehicle"][chunk_start:min(chunk_start + SCAN_CHUNK_RECORDS, last)]
+                matches = np.flatnonzero(chunk == code) + chunk_start
+                if len(matches):
+                    track.extend(self._decode(day, columns, matches))
+        return track
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_position_recorder():
+    """
+    Return the process-wide recorder, or None when recording is disabled.
+    """
+    global _recorder
+    if POSITION_HISTORY_DIR is None:
+        return None
+    if _recorder is None:
+        with _recorder_lock:
+            if _recorder is None:
+                _recorder = PositionRecorder()
+    return _recorder
+
+
+def shutdown_position_recorder(timeout=10):
+    """
+    Drain and stop the recorder, if it was started.
+    """
+    global _recorder
+    with _recorder_lock:
+        if _recorder is not None:
+            _recorder.close(timeout)
+            _recorder = None
@@ -0,0 +1,212 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+import envConfig  # noqa: F401  (loads .env into os.environ)
+
+# Opt-in per-request query profiler.
+# Set PROFILE_REQUESTS=1 to enable it, PROFILE_CPROFILE_SAMPLE_RATE (0.0 - 1.0)
+# to attach a cProfile dump to a fraction of requests.
+# Reference: https://docs.sqlalchemy.org/en/20/core/events.html#sqlalchemy.events.ConnectionEvents
+# Reference: https://fastapi.tiangolo.com/tutorial/middleware/
+PROFILING_ENABLED = os.getenv("PROFILE_REQUESTS", "0").lower() in ("1", "true", "yes")
+CPROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_CPROFILE_SAMPLE_RATE", "0"))
+MAX_STORED_PROFILES = int(os.getenv("PROFILE_MAX_STORED", "200"))
+N_PLUS_ONE_THRESHOLD = int(os.getenv("PROFILE_N_PLUS_ONE_THRESHOLD", "3"))
+
+# Profile of the request currently being handled. Starlette copies the context
+# into the threadpool used for sync endpoints, so the engine hooks see it too.
+_current_profile = ContextVar("current_profile", default=None)
+
+# Most recent profiles, keyed by request id (oldest evicted first)
+_profiles = OrderedDict()
+_profiles_lock = threading.Lock()
+
+# Only one cProfile hook can be active per interpreter (Python 3.12+ raises
+# on a second enable()), so at most one sampled request is profiled at a time
+_cprofile_lock = threading.Lock()
+
+# Patterns used to reduce a statement to its structure
+_IN_LIST_RE = re.compile(r"\((?:\s*(?:%\(\w+\)s|\?|:\w+|\$\d+)\s*,?)+\)")
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_statement(statement):
+    """
+    Reduce a SQL statement to its shape so that queries differing only in
+    literal values or IN-list length compare equal.
+    """
+    normalized = _STRING_RE.sub("?", statement)
+    normalized = _IN_LIST_RE.sub("(?)", normalized)
+    normalized = _NUMBER_RE.sub("?", normalized)
+    return _WHITESPACE_RE.sub(" ", normalized).strip()
+
+
+class RequestProfile:
+    """
+    Statements executed while serving a single request.
+    """
+
+    def __init__(self, request_id, method, path):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self.duration_ms = None
+        self.status_code = None
+        self.statements = []
+        self.cprofile_dump = None
+        self._lock = threading.Lock()
+
+    def record(self, statement, duration_ms, row_count):
+        with self._lock:
+            self.statements.append(
+                {
+                    "statement": statement,
+                    "duration_ms": round(duration_ms, 3),
+                    "row_count": row_count,
+                }
+            )
+
+    def repeated_statements(self):
+        """
+        Group structurally identical statements and return those executed at
+        least N_PLUS_ONE_THRESHOLD times (likely N+1 patterns).
+        """
+        groups = {}
+        for entry in self.statements:
+            key = normalize_statement(entry["statement"])
+            group = groups.setdefault(key, {"statement": key, "count": 0, "total_ms": 0.0})
+            group["count"] += 1
+            group["total_ms"] += entry["duration_ms"]
+
+        repeated = [g for g in groups.values() if g["count"] >= N_PLUS_ONE_THRESHOLD]
+        for group in repeated:
+            group["total_ms"] = round(group["total_ms"], 3)
+        return sorted(repeated, key=lambda g: g["total_ms"], reverse=True)
+
+    def summary_header(self):
+        """
+        Compact one-line summary suitable for a response header.
+        """
+        db_ms = sum(entry["duration_ms"] for entry in self.statements)
+        return "queries={};db_ms={:.1f};n_plus_one={}".format(
+            len(self.statements), db_ms, len(self.repeated_statements())
+        )
+
+    def to_dict(self):
+        return {
+            "request_id": self.request_id,
+            "method": self.method,
+            "path": self.path,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "status_code": self.status_code,
+            "query_count": len(self.statements),
+            "db_time_ms": round(sum(entry["duration_ms"] for entry in self.statements), 3),
+            "n_plus_one": self.repeated_statements(),
+            "statements": self.statements,
+            "cprofile": self.cprofile_dump,
+        }
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_profile.get() is not None:
+        conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current_profile.get()
+    if profile is None:
+        return
+    started = conn.info.get("profile_query_start")
+    if not started:
+        return
+    duration_ms = (time.perf_counter() - started.pop()) * 1000
+    profile.record(statement, duration_ms, cursor.rowcount)
+
+
+def _store_profile(profile):
+    with _profiles_lock:
+        _profiles[profile.request_id] = profile
+        while len(_profiles) > MAX_STORED_PROFILES:
+            _profiles.popitem(last=False)
+
+
+def get_profile(request_id):
+    """
+    Return a stored profile by request id, or None if it was never recorded
+    or has already been evicted.
+    """
+    with _profiles_lock:
+        return _profiles.get(request_id)
+
+
+def install_profiler(app, engine):
+    """
+    Hook the engine events and register the profiling middleware on the app.
+
+    The optional cProfile dump covers the event-loop thread (async handlers,
+    middleware and response serialisation) for the duration of the request,
+    including work of other requests interleaved on the loop meanwhile; time
+    spent inside sync handlers is visible through the per-statement timings
+    instead. Sampled requests arriving while another is being profiled are
+    not profiled.
+    """
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+    @app.middleware("http")
+    async def profile_request(request, call_next):
+        # Never profile the profile endpoint itself
+        if request.url.path.startswith("/debug/profile"):
+            return await call_next(request)
+
+        request_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+        profile = RequestProfile(request_id, request.method, request.url.path)
+        token = _current_profile.set(profile)
+
+        profiler = None
+        if (
+            CPROFILE_SAMPLE_RATE > 0
+            and random.random() < CPROFILE_SAMPLE_RATE
+            and _cprofile_lock.acquire(blocking=False)
+        ):
+            try:
+                profiler = cProfile.Profile()
+                profiler.enable()
+            except ValueError:
+                # Another profiling tool (e.g. a debugger) holds the hook
+                profiler = None
+                _cprofile_lock.release()
+
+        started = time.perf_counter()
+        try:
+            response = await call_next(request)
+        finally:
+            profile.duration_ms = round((time.perf_counter() - started) * 1000, 3)
+            if profiler is not None:
+                profiler.disable()
+                _cprofile_lock.release()
+                output = io.StringIO()
+                pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(40)
+                profile.cprofile_dump = output.getvalue()
+            _current_profile.reset(token)
+            _store_profile(profile)
+
+        profile.status_code = response.status_code
+        response.headers["X-Profile-Id"] = request_id
+        response.headers["X-Profile-Summary"] = profile.summary_header()
+        return response
@@ -0,0 +1,419 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from timetable import format_seconds, get_timetable, parse_seconds
+
+# In-memory journey planner based on RAPTOR (Round-bAsed Public Transit Optimized Router).
+# Trips sharing the same stop sequence are grouped into patterns, each stored as
+# a (trips x stops) matrix of departure/arrival seconds, and every round of the
+# algorithm adds one more vehicle ride to the journeys explored so far.
+# Reference: https://www.microsoft.com/en-us/research/publication/round-based-public-transit-routing/
+# Reference: https://docs.python.org/3/library/concurrent.futures.html#processpoolexecutor
+
+MAX_WALK_METERS = float(os.getenv("PLANNER_MAX_WALK_METERS", "400"))
+WALK_SPEED_MPS = float(os.getenv("PLANNER_WALK_SPEED_MPS", "1.3"))
+MAX_ROUNDS = int(os.getenv("PLANNER_MAX_ROUNDS", "5"))
+# Planner processes per uvicorn worker. By default the cores are shared
+# among the uvicorn workers (WEB_CONCURRENCY, which uvicorn --workers reads)
+# and capped, so N workers do not each fork one process per core
+MAX_DEFAULT_PLANNER_WORKERS = 4
+PLANNER_WORKERS = int(
+    os.getenv(
+        "PLANNER_WORKERS",
+        str(max(1, min(MAX_DEFAULT_PLANNER_WORKERS, (os.cpu_count() or 1) // int(os.getenv("WEB_CONCURRENCY", "1"))))),
+    )
+)
+
+EARTH_RADIUS_METERS = 6371000.0
+INFINITY = 2 ** 31 - 1
+
+
+class Router:
+    """
+    RAPTOR router over the compact timetable.
+    """
+
+    def __init__(self, timetable):
+        self.timetable = timetable
+        n_stops = len(timetable.stop_ids)
+
+        # Local equirectangular projection (meters) used for walking distances
+        lat0 = np.radians(np.nanmean(timetable.stop_lat)) if n_stops else 0.0
+        self.stop_x = np.radians(timetable.stop_lon) * np.cos(lat0) * EARTH_RADIUS_METERS
+        self.stop_y = np.radians(timetable.stop_lat) * EARTH_RADIUS_METERS
+        self._lat0 = lat0
+
+        self._build_patterns()
+        self._build_transfers()
+        self._active_trips = {}
+
+    def _build_patterns(self):
+        tt = self.timetable
+        starts = tt.trip_stop_time_start
+        stop_list = tt.stop_time_stop.tolist()
+
+        # Group trips by their exact stop sequence
+        groups = {}
+        for trip_idx in range(len(tt.trip_ids)):
+            start, end = starts[trip_idx], starts[trip_idx + 1]
+            if end - start < 2:
+                continue
+            groups.setdefault(tuple(stop_list[start:end]), []).append(trip_idx)
+
+        self.pattern_stops = []
+        self.pattern_trips = []
+        self.pattern_departures = []
+        self.pattern_arrivals = []
+        self.stop_patterns = [[] for _ in range(len(tt.stop_ids))]
+
+        for stops, trips in groups.items():
+            rows = np.array([starts[t] for t in trips], dtype=np.int64)[:, None] + np.arange(len(stops))
+            departures = tt.stop_time_departure[rows]
+            arrivals = tt.stop_time_arrival[rows]
+
+            # Sort trips by their first departure so each column can be searched
+            order = np.argsort(departures[:, 0], kind="stable")
+            pattern = len(self.pattern_stops)
+            self.pattern_stops.append(list(stops))
+            self.pattern_trips.append(np.asarray(trips, dtype=np.int32)[order])
+            self.pattern_departures.append(np.ascontiguousarray(departures[order].T))
+            self.pattern_arrivals.append(np.ascontiguousarray(arrivals[order].T))
+            for position, stop in enumerate(stops):
+                self.stop_patterns[stop].append((pattern, position))
+
+    def _build_transfers(self):
+        """
+        Precompute walking transfers between stops within MAX_WALK_METERS,
+        bucketing stops into a grid so only neighbouring cells are compared.
+        """
+        n_stops = len(self.stop_x)
+        self.transfers = [[] for _ in range(n_stops)]
+        valid = np.flatnonzero(~np.isnan(self.stop_x) & ~np.isnan(self.stop_y))
+        if len(valid) == 0:
+            return
+
+        cell_x = np.floor(self.stop_x[valid] / MAX_WALK_METERS).astype(np.int64)
+        cell_y = np.floor(self.stop_y[valid] / MAX_WALK_METERS).astype(np.int64)
+        cells = {}
+        for stop, cx, cy in zip(valid.tolist(), cell_x.tolist(), cell_y.tolist()):
+            cells.setdefault((cx, cy), []).append(stop)
+
+        for (cx, cy), members in cells.items():
+            neighbours = [
+                stop
+                for dx in (-1, 0, 1)
+                for dy in (-1, 0, 1)
+                for stop in cells.get((cx + dx, cy + dy), ())
+            ]
+            members = np.asarray(members)
+            neighbours = np.asarray(neighbours)
+            distances = np.hypot(
+                self.stop_x[members][:, None] - self.stop_x[neighbours][None, :],
+                self.stop_y[members][:, None] - self.stop_y[neighbours][None, :],
+            )
+            for row, stop in enumerate(members.tolist()):
+                close = np.flatnonzero((distances[row] <= MAX_WALK_METERS) & (neighbours != stop))
+                self.transfers[stop] = [
+                    (int(neighbours[i]), int(np.ceil(distances[row, i] / WALK_SPEED_MPS)))
+                    for i in close
+                ]
+
+    def nearby_stops(self, latitude, longitude, radius=MAX_WALK_METERS):
+        """
+        Return {stop_index: walking seconds} for stops within radius of a point.
+        """
+        x = np.radians(longitude) * np.cos(self._lat0) * EARTH_RADIUS_METERS
+        y = np.radians(latitude) * EARTH_RADIUS_METERS
+        distances = np.hypot(self.stop_x - x, self.stop_y - y)
+        close = np.flatnonzero(distances <= radius)
+        return {int(i): int(np.ceil(distances[i] / WALK_SPEED_MPS)) for i in close}
+
+    def active_trips(self, service_date):
+        mask = self._active_trips.get(service_date)
+        if mask is None:
+            mask = self.timetable.active_trip_mask(service_date)
+            self._active_trips = {service_date: mask}
+        return mask
+
+    def _earliest_trip(self, pattern, position, earliest, active):
+        """
+        Row of the first active trip departing `position` at or after `earliest`.
+        """
+        column = self.pattern_departures[pattern][position]
+        trips = self.pattern_trips[pattern]
+        row = int(np.searchsorted(column, earliest))
+        while row < len(column):
+            if active[trips[row]] and column[row] >= earliest:
+                return row
+            row += 1
+        return -1
+
+    def plan(self, origins, destinations, depart_seconds, service_date, max_rounds=MAX_ROUNDS):
+        """
+        Run RAPTOR from origin stops to destination stops.
+
+        origins/destinations map stop index -> walking seconds to/from the
+        actual endpoints. Returns the Pareto set of journeys (fewer rides vs.
+        earlier arrival), each as a list of legs.
+        """
+        active = self.active_trips(service_date)
+        n_stops = len(self.stop_patterns)
+        best = [INFINITY] * n_stops
+
+        # Per round: arrival labels, how each label was reached, and the
+        # ride that produced trip labels (kept apart from walking labels)
+        labels = [[INFINITY] * n_stops]
+        parents = [{}]
+        rides = [{}]
+
+        marked = set()
+        for stop, walk in origins.items():
+            arrival = depart_seconds + walk
+            if arrival < labels[0][stop]:
+                labels[0][stop] = best[stop] = arrival
+                parents[0][stop] = ("access", walk)
+                marked.add(stop)
+        for stop in list(marked):
+            for neighbour, walk in self.transfers[stop]:
+                arrival = labels[0][stop] + walk
+                if arrival < labels[0][neighbour]:
+                    labels[0][neighbour] = best[neighbour] = arrival
+                    parents[0][neighbour] = ("walk", stop, walk)
+                    marked.add(neighbour)
+
+        journeys = []
+        best_target = self._target_arrival(labels[0], destinations)
+        # Destination within walking distance: the walk is the zero-ride journey
+        if best_target < INFINITY:
+            journeys.append(self._reconstruct(0, labels[0], parents, rides, destinations))
+
+        for k in range(1, max_rounds + 1):
+            if not marked:
+                break
+            previous = labels[k - 1]
+            current = list(previous)
+            labels.append(current)
+            parents.append({})
+            rides.append({})
+
+            # Earliest marked position on every pattern serving a marked stop
+            queue = {}
+            for stop in marked:
+                for pattern, position in self.stop_patterns[stop]:
+                    if position < queue.get(pattern, INFINITY):
+                        queue[pattern] = position
+
+            improved = set()
+            for pattern, first_position in queue.items():
+                stops = self.pattern_stops[pattern]
+                departures = self.pattern_departures[pattern]
+                arrivals = self.pattern_arrivals[pattern]
+                row = -1
+                board_position = -1
+                for position in range(first_position, len(stops)):
+                    stop = stops[position]
+                    if row >= 0:
+                        arrival = int(arrivals[position][row])
+                        if arrival < best[stop] and arrival < best_target:
+                            current[stop] = best[stop] = arrival
+                            parents[k][stop] = ("ride",)
+                            rides[k][stop] = (pattern, row, board_position, position)
+                            improved.add(stop)
+                    # Switch to an earlier trip if we could have been here before it
+                    reached = previous[stop]
+                    if reached < INFINITY and (row < 0 or reached < departures[position][row]):
+                        candidate = self._earliest_trip(pattern, position, reached, active)
+                        if candidate >= 0 and (
+                            row < 0 or departures[position][candidate] < departures[position][row]
+                        ):
+                            row = candidate
+                            board_position = position
+
+            # Footpaths from stops reached by a ride in this round
+            marked = set(improved)
+            for stop in improved:
+                for neighbour, walk in self.transfers[stop]:
+                    arrival = current[stop] + walk
+                    if arrival < best[neighbour] and arrival < best_target:
+                        current[neighbour] = best[neighbour] = arrival
+                        parents[k][neighbour] = ("walk", stop, walk)
+                        marked.add(neighbour)
+
+            target = self._target_arrival(current, destinations)
+            if target < best_target:
+                best_target = target
+                journeys.append(self._reconstruct(k, current, parents, rides, destinations))
+
+        return journeys
+
+    @staticmethod
+    def _target_arrival(labels, destinations):
+        return min(
+            (labels[stop] + walk for stop, walk in destinations.items() if labels[stop] < INFINITY),
+            default=INFINITY,
+        )
+
+    def _reconstruct(self, k, current, parents, rides, destinations):
+        tt = self.timetable
+        stop, egress = min(destinations.items(), key=lambda item: current[item[0]] + item[1])
+        legs = []
+        if egress > 0:
+            legs.append(
+                {
+                    "type": "walk",
+                    "from_stop_id": str(tt.stop_ids[stop]),
+                    "to_stop_id": None,
+                    "duration": egress,
+                }
+            )
+
+        while True:
+            # Labels carried over from earlier rounds keep their original parent
+            while k > 0 and stop not in parents[k]:
+                k -= 1
+            parent = parents[k].get(stop)
+            if parent is None or parent[0] == "access":
+                if parent is not None and parent[1] > 0:
+                    legs.append(
+                        {"type": "walk", "from_stop_id": None, "to_stop_id": str(tt.stop_ids[stop]), "duration": parent[1]}
+                    )
+                break
+            if parent[0] == "walk":
+                _, origin, walk = parent
+                legs.append(
+                    {
+                        "type": "walk",
+                        "from_stop_id": str(tt.stop_ids[origin]),
+                        "to_stop_id": str(tt.stop_ids[stop]),
+                        "duration": walk,
+                    }
+                )
+                stop = origin
+                continue
+
+            pattern, row, board_position, alight_position = rides[k][stop]
+            trip_idx = int(self.pattern_trips[pattern][row])
+            route_idx = tt.trip_route[trip_idx]
+            board_stop = self.pattern_stops[pattern][board_position]
+            legs.append(
+                {
+                    "type": "transit",
+                    "trip_id": str(tt.trip_ids[trip_idx]),
+                    "route_id": str(tt.route_ids[route_idx]),
+                    "route_short_name": str(tt.route_short_names[route_idx]),
+                    "trip_headsign": str(tt.trip_headsigns[trip_idx]),
+                    "from_stop_id": str(tt.stop_ids[board_stop]),
+                    "to_stop_id": str(tt.stop_ids[stop]),
+                    "departure_time": format_seconds(
+                        int(self.pattern_departures[pattern][board_position][row])
+                    ),
+                    "arrival_time": format_seconds(
+                        int(self.pattern_arrivals[pattern][alight_position][row])
+                    ),
+                }
+            )
+            stop = board_stop
+            k -= 1
+
+        legs.reverse()
+        return {
+            "transfers": max(sum(1 for leg in legs if leg["type"] == "transit") - 1, 0),
+            "legs": legs,
+        }
+
+
+_router = None
+_router_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_router():
+    """
+    Return the process-wide router, building it on first use.
+    """
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = Router(get_timetable())
+    return _router
+
+
+def plan_journey(origin, destination, depart_seconds, service_date, max_rounds=MAX_ROUNDS):
+    """
+    Plan a journey between two endpoints. Each endpoint is either a stop_id
+    or a (latitude, longitude) pair. Runs inside the worker pool.
+    """
+    router = get_router()
+    origins = _resolve_endpoint(router, origin)
+    destinations = _resolve_endpoint(router, destination)
+    if not origins or not destinations:
+        return []
+    journeys = router.plan(origins, destinations, depart_seconds, service_date, max_rounds)
+    for journey in journeys:
+        journey["departure_time"] = format_seconds(depart_seconds)
+        journey["arrival_time"] = _journey_arrival(journey, depart_seconds)
+    return journeys
+
+
+def _resolve_endpoint(router, endpoint):
+    if isinstance(endpoint, str):
+        stop = router.timetable.stop_index.get(endpoint)
+        return {} if stop is None else {stop: 0}
+    latitude, longitude = endpoint
+    return router.nearby_stops(latitude, longitude)
+
+
+def _journey_arrival(journey, depart_seconds):
+    """
+    Arrival time of a journey: last transit arrival plus any trailing walk.
+    """
+    arrival = depart_seconds
+    for leg in journey["legs"]:
+        if leg["type"] == "transit":
+            arrival = parse_seconds(leg["arrival_time"])
+        else:
+            arrival += leg["duration"]
+    return format_seconds(arrival)
+
+
+def get_executor():
+    """
+    Return the planner worker pool.
+
+    The router is built before the pool starts so forked workers inherit it
+    instead of rebuilding it from the database. Building the router and
+    forking the workers are both slow: call this from a thread, and warm it
+    from a background task at startup.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                if PLANNER_WORKERS > 1 and "fork" in multiprocessing.get_all_start_methods():
+                    get_router()
+                    _executor = ProcessPoolExecutor(
+                        max_workers=PLANNER_WORKERS,
+                        mp_context=multiprocessing.get_context("fork"),
+                    )
+                    # Fork the workers now rather than on the first request
+                    _executor.submit(os.getpid).result()
+                else:
+                    _executor = ThreadPoolExecutor(max_workers=1)
+    return _executor
+
+
+def shutdown_executor():
+    """
+    Stop the planner worker pool, if it was started.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True, cancel_futures=True)
+            _executor = None
@@ -0,0 +1,224 @@
+import os
+import tempfile
+import threading
+import uuid
+
+import envConfig  # noqa: F401  (loads .env into os.environ)
+
+# Pluggable realtime state shared between uvicorn worker processes.
+# One worker wins a leader lease and polls the upstream GTFS-realtime feeds;
+# it publishes decoded snapshots that every worker (itself included) reads
+# back, so feed traffic and decoding do not grow with the worker count.
+#
+# REALTIME_STATE_BACKEND selects the implementation:
+#   local - single process, no sharing (default)
+#   shm   - single host, lease via flock and snapshots on tmpfs (/dev/shm)
+#   redis - any number of hosts, lease via SET NX PX and snapshots in keys
+# Reference: https://docs.python.org/3/library/fcntl.html#fcntl.flock
+# Reference: https://redis.io/docs/latest/develop/use/patterns/distributed-locks/
+REALTIME_STATE_BACKEND = os.getenv("REALTIME_STATE_BACKEND", "local").lower()
+REALTIME_STATE_DIR = os.getenv(
+    "REALTIME_STATE_DIR",
+    "/dev/shm/bt_transit" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "bt_transit"),
+)
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "bt_transit:")
+LEADER_LEASE_SECONDS = float(os.getenv("REALTIME_LEADER_LEASE_SECONDS", "10"))
+
+# How often the leader polls vehicle positions, and how often every worker
+# checks for new snapshots (its WebSocket clients are woken when one lands)
+POSITIONS_POLL_SECONDS = float(os.getenv("POSITIONS_POLL_SECONDS", "2"))
+REALTIME_TICK_SECONDS = float(os.getenv("REALTIME_TICK_SECONDS", "0.5"))
+# Upstream feed requests give up after this long. The leader polls up to
+# three feeds per tick, so keep three timeouts under the leader lease
+REALTIME_FETCH_TIMEOUT_SECONDS = float(os.getenv("REALTIME_FETCH_TIMEOUT_SECONDS", "3"))
+
+
+class LocalStateBackend:
+    """
+    In-process backend: this process is always the leader.
+    """
+
+    def __init__(self):
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def try_acquire_leadership(self):
+        return True
+
+    def publish(self, channel, payload):
+        with self._lock:
+            version = self._snapshots.get(channel, (0, None))[0] + 1
+            self._snapshots[channel] = (version, payload)
+        return version
+
+    def latest(self, channel):
+        """
+        Return (version, payload) of the newest snapshot, or None.
+        """
+        return self._snapshots.get(channel)
+
+    def close(self):
+        pass
+
+
+class SharedMemoryStateBackend:
+    """
+    Single-host backend for several worker processes.
+
+    The leader holds an exclusive flock on a lock file for as long as it runs;
+    the kernel releases it if the process dies, so another worker takes over
+    on its next attempt. Snapshots are written to a tmpfs directory and
+    swapped in atomically with os.replace; readers only re-read a file when
+    its inode changes.
+    """
+
+    def __init__(self, directory=REALTIME_STATE_DIR):
+        import fcntl
+
+        self._fcntl = fcntl
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, "leader.lock"), "a+")
+        self._is_leader = False
+        self._versions = {}
+        self._cache = {}
+
+    def try_acquire_leadership(self):
+        if not self._is_leader:
+            try:
+                self._fcntl.flock(self._lock_file, self._fcntl.LOCK_EX | self._fcntl.LOCK_NB)
+                self._is_leader = True
+            except BlockingIOError:
+                return False
+        return True
+
+    def _path(self, channel):
+        return os.path.join(self.directory, channel + ".snapshot")
+
+    def publish(self, channel, payload):
+        # Continue the sequence of a previous leader when taking over
+        previous = self.latest(channel)
+        version = max(self._versions.get(channel, 0), previous[0] if previous else 0) + 1
+        self._versions[channel] = version
+        path = self._path(channel)
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary, "wb") as f:
+            f.write(str(version).encode() + b"\n" + payload)
+        os.replace(temporary, path)
+        return version
+
+    def latest(self, channel):
+        try:
+            stat = os.stat(self._path(channel))
+        except FileNotFoundError:
+            return None
+        key = (stat.st_ino, stat.st_mtime_ns)
+        cached = self._cache.get(channel)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        with open(self._path(channel), "rb") as f:
+            version, _, payload = f.read().partition(b"\n")
+        snapshot = (int(version), payload)
+        self._cache[channel] = (key, snapshot)
+        return snapshot
+
+    def close(self):
+        if self._is_leader:
+            self._fcntl.flock(self._lock_file, self._fcntl.LOCK_UN)
+            self._is_leader = False
+        self._lock_file.close()
+
+
+class RedisStateBackend:
+    """
+    Multi-host backend on a Redis-compatible server.
+
+    Any client exposing the redis-py API can be passed in (for example a
+    local stand-in during tests); otherwise one is created from REDIS_URL.
+    """
+
+    # Extend the lease only if we still own it
+    RENEW_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+
+    def __init__(self, client=None, url=REDIS_URL, prefix=REDIS_KEY_PREFIX):
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.worker_id = "{}:{}".format(os.getpid(), uuid.uuid4().hex)
+        self._lease_ms = int(LEADER_LEASE_SECONDS * 1000)
+        self._cache = {}
+
+    def try_acquire_leadership(self):
+        key = self.prefix + "leader"
+        if self.client.set(key, self.worker_id, nx=True, px=self._lease_ms):
+            return True
+        return bool(self.client.eval(self.RENEW_SCRIPT, 1, key, self.worker_id, self._lease_ms))
+
+    def publish(self, channel, payload):
+        key = self.prefix + channel
+        version = self.client.incr(key + ":version")
+        self.client.set(key + ":payload", str(version).encode() + b"\n" + payload)
+        return version
+
+    def latest(self, channel):
+        key = self.prefix + channel
+        version = self.client.get(key + ":version")
+        if version is None:
+            return None
+        cached = self._cache.get(channel)
+        if cached is not None and cached[0] == int(version):
+            return cached
+        raw = self.client.get(key + ":payload")
+        if raw is None:
+            return None
+        stored_version, _, payload = raw.partition(b"\n")
+        snapshot = (int(stored_version), payload)
+        self._cache[channel] = snapshot
+        return snapshot
+
+    def close(self):
+        key = self.prefix + "leader"
+        if self.client.get(key) == self.worker_id.encode():
+            self.client.delete(key)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def create_state_backend(name=REALTIME_STATE_BACKEND):
+    if name == "shm":
+        return SharedMemoryStateBackend()
+    if name == "redis":
+        return RedisStateBackend()
+    if name == "local":
+        return LocalStateBackend()
+    raise ValueError(f"Unknown REALTIME_STATE_BACKEND: {name}")
+
+
+def get_state_backend():
+    """
+    Return the process-wide realtime state backend.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_state_backend()
+    return _backend
+
+
+def close_state_backend():
+    global _backend
+    if _backend is not None:
+        _backend.close()
+        _backend = None
@@ -0,0 +1,281 @@
+import argparse
+import bisect
+import glob
+import math
+import os
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from gtfs_realtime_pb2 import FeedMessage
+
+# Local GTFS-realtime replay server for offline load testing.
+# Serves vehicle positions, trip updates and alerts on the same paths the
+# backend polls, either by replaying recorded protobuf files in order or by
+# generating synthetic vehicles. Synthetic vehicles drive along the shapes of
+# trips from the database, so the backend resolves and snaps them like real
+# ones; --circles drives them around a centre point instead (no database
+# needed, but the backend drops vehicles it cannot match to a trip).
+# Point the GTFS_REAL_TIME_*_URL settings at
+# http://<host>:<port>/positions, /trip-updates and /alerts.
+#
+# Recorded mode expects one directory per feed, with files sorted by name:
+#   <dir>/positions/*.pb  <dir>/trip-updates/*.pb  <dir>/alerts/*.pb
+# Reference: https://docs.python.org/3/library/http.server.html
+# Reference: https://gtfs.org/realtime/reference/
+
+FEEDS = ("positions", "trip-updates", "alerts")
+
+EARTH_RADIUS_METERS = 6371000.0
+
+# Synthetic vehicle speed (m/s)
+SYNTHETIC_SPEED_METERS = 8.0
+
+
+class ShapePath:
+    """
+    A trip's shape as a polyline with cumulative distances, so a distance
+    along it maps to a point and a bearing.
+    """
+
+    def __init__(self, points):
+        self.points = points
+        self.distances = [0.0]
+        for (lat1, lon1), (lat2, lon2) in zip(points, points[1:]):
+            self.distances.append(self.distances[-1] + _distance(lat1, lon1, lat2, lon2))
+        self.length = self.distances[-1]
+
+    def locate(self, along):
+        """
+        (lat, lon, bearing) at a distance along the shape, looping at the end.
+        """
+        if self.length <= 0:
+            lat, lon = self.points[0]
+            return lat, lon, 0.0
+        along %= self.length
+        i = min(max(bisect.bisect_right(self.distances, along) - 1, 0), len(self.points) - 2)
+        (lat1, lon1), (lat2, lon2) = self.points[i], self.points[i + 1]
+        span = self.distances[i + 1] - self.distances[i]
+        fraction = (along - self.distances[i]) / span if span > 0 else 0.0
+        bearing = math.degrees(
+            math.atan2((lon2 - lon1) * math.cos(math.radians(lat1)), lat2 - lat1)
+        ) % 360
+        return lat1 + (lat2 - lat1) * fraction, lon1 + (lon2 - lon1) * fraction, bearing
+
+
+def _distance(lat1, lon1, lat2, lon2):
+    """
+    Equirectangular distance in meters (accurate at street scale).
+    """
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS_METERS * math.hypot(x, y)
+
+
+class RecordedFeed:
+    """
+    Replays recorded feed files, advancing one file per interval / speed.
+    """
+
+    def __init__(self, directory, interval, speed):
+        self.files = sorted(glob.glob(os.path.join(directory, "*.pb")))
+        self.interval = interval
+        self.speed = speed
+        self.started_at = time.monotonic()
+        self._cache = {}
+
+    def current(self):
+        if not self.files:
+            return FeedMessage().SerializeToString()
+        step = int((time.monotonic() - self.started_at) * self.speed / self.interval)
+        path = self.files[step % len(self.files)]
+        payload = self._cache.get(path)
+        if payload is None:
+            with open(path, "rb") as f:
+                payload = f.read()
+            self._cache = {path: payload}
+        return payload
+
+
+class SyntheticFeeds:
+    """
+    Generates vehicles with matching trip updates and a handful of alerts.
+    Given trip shapes ([(trip_id, ShapePath)]), each vehicle drives along its
+    trip's shape; otherwise it drives a circle around the centre point.
+    """
+
+    def __init__(self, vehicles, speed, center, radius, trip_shapes=()):
+        self.vehicles = vehicles
+        self.speed = speed
+        self.center = center
+        self.radius = radius
+        self.trip_shapes = list(trip_shapes)
+        if self.trip_shapes:
+            self.trip_ids = [trip_id for trip_id, _ in self.trip_shapes]
+        else:
+            self.trip_ids = ["synthetic_{}".format(i) for i in range(vehicles)]
+        self.started_at = time.time()
+        seeded = random.Random(42)
+        self.phases = [seeded.random() for _ in range(vehicles)]
+        self.delays = [seeded.randint(-120, 600) for _ in range(vehicles)]
+
+    def _now(self):
+        return self.started_at + (time.time() - self.started_at) * self.speed
+
+    def _header(self, feed, now):
+        feed.header.gtfs_realtime_version = "2.0"
+        feed.header.timestamp = int(now)
+
+    def positions(self):
+        now = self._now()
+        feed = FeedMessage()
+        self._header(feed, now)
+        travelled = (now - self.started_at) * SYNTHETIC_SPEED_METERS
+        for i in range(self.vehicles):
+            if self.trip_shapes:
+                path = self.trip_shapes[i % len(self.trip_shapes)][1]
+                lat, lon, bearing = path.locate(self.phases[i] * path.length + travelled)
+            else:
+                lat, lon, bearing = self._circle(self.phases[i] * 2 * math.pi + travelled / self.radius)
+            entity = feed.entity.add()
+            entity.id = "vehicle_{}".format(i)
+            entity.vehicle.vehicle.id = "bus_{}".format(i)
+            entity.vehicle.trip.trip_id = self.trip_ids[i % len(self.trip_ids)]
+            entity.vehicle.position.latitude = lat
+            entity.vehicle.position.longitude = lon
+            entity.vehicle.position.bearing = bearing
+            entity.vehicle.timestamp = int(now)
+        return feed.SerializeToString()
+
+    def _circle(self, angle):
+        lat0, lon0 = self.center
+        dlat = math.degrees(self.radius * math.sin(angle) / EARTH_RADIUS_METERS)
+        dlon = math.degrees(
+            self.radius * math.cos(angle) / (EARTH_RADIUS_METERS * math.cos(math.radians(lat0)))
+        )
+        return lat0 + dlat, lon0 + dlon, math.degrees(angle + math.pi / 2) % 360
+
+    def trip_updates(self):
+        now = self._now()
+        feed = FeedMessage()
+        self._header(feed, now)
+        for i in range(self.vehicles):
+            entity = feed.entity.add()
+            entity.id = "trip_update_{}".format(i)
+            entity.trip_update.trip.trip_id = self.trip_ids[i % len(self.trip_ids)]
+            update = entity.trip_update.stop_time_update.add()
+            update.stop_sequence = 1
+            update.arrival.delay = self.delays[i]
+        return feed.SerializeToString()
+
+    def alerts(self):
+        feed = FeedMessage()
+        self._header(feed, self._now())
+        for i in range(min(5, self.vehicles)):
+            entity = feed.entity.add()
+            entity.id = "alert_{}".format(i)
+            entity.alert.header_text.translation.add(text="Synthetic alert {}".format(i), language="en")
+            informed = entity.alert.informed_entity.add()
+            informed.trip.trip_id = self.trip_ids[i % len(self.trip_ids)]
+        return feed.SerializeToString()
+
+
+def make_handler(sources):
+    class ReplayHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            source = sources.get(self.path.strip("/"))
+            if source is None:
+                self.send_error(404)
+                return
+            payload = source()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-protobuf")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ReplayHandler
+
+
+def load_trip_shapes(limit):
+    """
+    Trips with a shape from the database, as [(trip_id, ShapePath)], so
+    synthetic vehicles run real trips along their routes.
+    """
+    from database import SessionLocal
+    from models import Shape, Trip
+
+    db = SessionLocal()
+    try:
+        trips = (
+            db.query(Trip.trip_id, Trip.shape_id)
+            .filter(Trip.shape_id.isnot(None), Trip.shape_id != "")
+            .order_by(Trip.trip_id)
+            .limit(limit)
+            .all()
+        )
+        shape_ids = {shape_id for _, shape_id in trips}
+        points = {}
+        rows = (
+            db.query(Shape.shape_id, Shape.shape_pt_lat, Shape.shape_pt_lon)
+            .filter(Shape.shape_id.in_(shape_ids))
+            .order_by(Shape.shape_id, Shape.shape_pt_sequence)
+        )
+        for shape_id, lat, lon in rows:
+            points.setdefault(shape_id, []).append((float(lat), float(lon)))
+        paths = {shape_id: ShapePath(shape) for shape_id, shape in points.items() if len(shape) >= 2}
+        return [(trip_id, paths[shape_id]) for trip_id, shape_id in trips if shape_id in paths]
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve recorded or synthetic GTFS-realtime feeds.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--recorded", help="Directory with positions/, trip-updates/ and alerts/ .pb files")
+    parser.add_argument("--interval", type=float, default=2.0, help="Seconds between recorded files")
+    parser.add_argument("--speed", type=float, default=1.0, help="Playback speed multiplier")
+    parser.add_argument("--vehicles", type=int, default=200, help="Synthetic vehicle count")
+    parser.add_argument(
+        "--circles",
+        action="store_true",
+        help="Drive synthetic vehicles in circles instead of along database trip shapes",
+    )
+    parser.add_argument("--center", default="39.1653,-86.5264", help="Circle centre lat,lon (--circles)")
+    parser.add_argument("--radius", type=float, default=3000.0, help="Circle radius in meters (--circles)")
+    args = parser.parse_args()
+
+    if args.recorded:
+        feeds = {
+            name: RecordedFeed(os.path.join(args.recorded, name), args.interval, args.speed)
+            for name in FEEDS
+        }
+        sources = {name: feed.current for name, feed in feeds.items()}
+    else:
+        lat, lon = (float(value) for value in args.center.split(","))
+        trip_shapes = () if args.circles else load_trip_shapes(args.vehicles)
+        if not args.circles and not trip_shapes:
+            parser.error("No trips with shapes in the database; load the static feed or pass --circles")
+        synthetic = SyntheticFeeds(args.vehicles, args.speed, (lat, lon), args.radius, trip_shapes)
+        sources = {
+            "positions": synthetic.positions,
+            "trip-updates": synthetic.trip_updates,
+            "alerts": synthetic.alerts,
+        }
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(sources))
+    print(f"Serving GTFS-realtime replay on http://{args.host}:{args.port}/{{{','.join(FEEDS)}}}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
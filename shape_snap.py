@@ -0,0 +1,330 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from database import engine
+from snapshot import SNAPSHOT_DIR, load_arrays, save_arrays
+from timetable import get_feed_version, get_timetable
+
+# Snap raw vehicle GPS positions onto the trip's shape polyline.
+# Shape points are projected once into a local metric plane and stored as
+# flat segment arrays; segment i joins point i and point i + 1, and the
+# segments of shape s are segment_start[s]:segment_end[s]. Snapping a whole
+# feed tick is a single vectorized pass over the candidate segments.
+# Reference: https://numpy.org/doc/stable/reference/generated/numpy.lexsort.html
+# Reference: https://gtfs.org/schedule/reference/#shapestxt
+
+# Positions further than this from the shape are left unsnapped (detours)
+MAX_SNAP_METERS = float(os.getenv("SHAPE_MAX_SNAP_METERS", "75"))
+# A vehicle is only searched for from this far behind its last snapped
+# position on the same trip (GPS jitter), so the return leg of an
+# out-and-back or the second pass of a loop is not mistaken for the first
+BACKTRACK_METERS = float(os.getenv("SHAPE_BACKTRACK_METERS", "100"))
+
+EARTH_RADIUS_METERS = 6371000.0
+
+
+class ShapeIndex:
+    """
+    Shape polylines held as flat numpy arrays, with per-shape segment ranges.
+    """
+
+    ARRAY_FIELDS = (
+        "shape_ids", "point_lat", "point_lon", "point_dist", "point_traveled", "shape_point_start",
+    )
+
+    def __init__(self, arrays, timetable):
+        for name in self.ARRAY_FIELDS:
+            setattr(self, name, arrays[name])
+        self.timetable = timetable
+        self.shape_index = {shape_id: i for i, shape_id in enumerate(self.shape_ids.tolist())}
+
+        self._lat0 = np.radians(np.nanmean(self.point_lat)) if len(self.point_lat) else 0.0
+        self.point_x, self.point_y = self.project(self.point_lat, self.point_lon)
+
+        # Segment i runs from point i to point i + 1 within the same shape
+        self.segment_start = self.shape_point_start[:-1]
+        self.segment_end = np.maximum(self.shape_point_start[1:] - 1, self.segment_start)
+        n_points = len(self.point_x)
+        following = np.minimum(np.arange(n_points) + 1, max(n_points - 1, 0))
+        self.segment_dx = self.point_x[following] - self.point_x
+        self.segment_dy = self.point_y[following] - self.point_y
+        last_points = self.shape_point_start[1:][self.shape_point_start[1:] > self.shape_point_start[:-1]] - 1
+        self.segment_dx[last_points] = 0.0
+        self.segment_dy[last_points] = 0.0
+        self.segment_length2 = self.segment_dx ** 2 + self.segment_dy ** 2
+
+        # Shape index per trip (-1 when the trip has no known shape)
+        self.trip_shape = (
+            pd.Index(self.shape_ids).get_indexer(timetable.trip_shape_ids).astype(np.int32)
+            if len(self.shape_ids)
+            else np.full(len(timetable.trip_ids), -1, dtype=np.int32)
+        )
+        self._trip_stop_dist = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_database(cls, timetable, bind=engine):
+        shapes = pd.read_sql(
+            "SELECT shape_id, shape_pt_lat, shape_pt_lon, shape_pt_sequence, shape_dist_traveled FROM shapes", bind
+        )
+        return cls(cls._build_arrays(shapes), timetable)
+
+    @staticmethod
+    def _build_arrays(shapes):
+        shapes = shapes.assign(
+            shape_pt_lat=pd.to_numeric(shapes["shape_pt_lat"], errors="coerce"),
+            shape_pt_lon=pd.to_numeric(shapes["shape_pt_lon"], errors="coerce"),
+        ).dropna(subset=["shape_pt_lat", "shape_pt_lon"])
+        shapes = shapes.sort_values(["shape_id", "shape_pt_sequence"], kind="mergesort")
+
+        shape_codes, shape_ids = pd.factorize(shapes["shape_id"].astype(str), sort=True)
+        point_lat = shapes["shape_pt_lat"].to_numpy(dtype=np.float64)
+        point_lon = shapes["shape_pt_lon"].to_numpy(dtype=np.float64)
+        shape_point_start = np.searchsorted(shape_codes, np.arange(len(shape_ids) + 1)).astype(np.int64)
+
+        # Cumulative haversine distance (meters) along each shape
+        lat = np.radians(point_lat)
+        lon = np.radians(point_lon)
+        step = np.zeros(len(lat))
+        if len(lat) > 1:
+            a = (
+                np.sin(np.diff(lat) / 2) ** 2
+                + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+            )
+            step[1:] = 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+        step[shape_point_start[:-1]] = 0.0
+        point_dist = np.cumsum(step)
+        point_dist -= np.repeat(point_dist[shape_point_start[:-1]], np.diff(shape_point_start))
+
+        return {
+            "shape_ids": np.asarray(shape_ids, dtype=str) if len(shape_ids) else np.array([], dtype="U1"),
+            "point_lat": point_lat,
+            "point_lon": point_lon,
+            "point_dist": point_dist,
+            # shape_dist_traveled as published (feed units, NaN when missing)
+            "point_traveled": pd.to_numeric(shapes["shape_dist_traveled"], errors="coerce").to_numpy(dtype=np.float64),
+            "shape_point_start": shape_point_start,
+        }
+
+    def to_arrays(self):
+        return {name: getattr(self, name) for name in self.ARRAY_FIELDS}
+
+    def project(self, latitude, longitude):
+        """
+        Project lat/lon (degrees) into the local metric plane.
+        """
+        latitude = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        x = np.radians(longitude) * np.cos(self._lat0) * EARTH_RADIUS_METERS
+        y = np.radians(latitude) * EARTH_RADIUS_METERS
+        return x, y
+
+    def snap(self, shapes, latitude, longitude, min_along=None):
+        """
+        Snap a batch of points onto their shapes in one vectorized pass.
+
+        shapes holds one shape index per point (-1 to skip). min_along
+        optionally holds, per point, a distance along the shape (meters)
+        before which segments are not considered. Returns arrays of snapped
+        latitude, snapped longitude, distance along the shape (meters) and
+        offset from the shape (meters); NaN where no shape is known, and an
+        infinite offset when no segment lies past min_along.
+        """
+        shapes = np.asarray(shapes, dtype=np.int64)
+        n = len(shapes)
+        snapped_lat = np.full(n, np.nan)
+        snapped_lon = np.full(n, np.nan)
+        along = np.full(n, np.nan)
+        offset = np.full(n, np.nan)
+
+        valid = np.flatnonzero(shapes >= 0)
+        if len(valid) == 0:
+            return snapped_lat, snapped_lon, along, offset
+
+        x, y = self.project(np.asarray(latitude)[valid], np.asarray(longitude)[valid])
+        first = self.segment_start[shapes[valid]]
+        counts = np.maximum(self.segment_end[shapes[valid]] - first, 1)
+
+        # Expand every point against every segment of its shape
+        owner = np.repeat(np.arange(len(valid)), counts)
+        group_start = np.cumsum(counts) - counts
+        segment = np.arange(counts.sum()) - np.repeat(group_start, counts) + np.repeat(first, counts)
+
+        px = x[owner] - self.point_x[segment]
+        py = y[owner] - self.point_y[segment]
+        length2 = self.segment_length2[segment]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t = np.where(
+                length2 > 0,
+                (px * self.segment_dx[segment] + py * self.segment_dy[segment]) / length2,
+                0.0,
+            )
+        t = np.clip(t, 0.0, 1.0)
+        distance2 = (px - t * self.segment_dx[segment]) ** 2 + (py - t * self.segment_dy[segment]) ** 2
+        if min_along is not None:
+            segment_end = self.point_dist[segment] + np.sqrt(length2)
+            distance2 = np.where(segment_end < np.asarray(min_along)[valid][owner], np.inf, distance2)
+
+        # Closest segment per point: sort by (owner, distance) and take group heads
+        order = np.lexsort((distance2, owner))
+        best = order[group_start]
+        best_segment = segment[best]
+        best_t = t[best]
+        following = np.minimum(best_segment + 1, len(self.point_lat) - 1)
+
+        snapped_lat[valid] = self.point_lat[best_segment] + best_t * (
+            self.point_lat[following] - self.point_lat[best_segment]
+        )
+        snapped_lon[valid] = self.point_lon[best_segment] + best_t * (
+            self.point_lon[following] - self.point_lon[best_segment]
+        )
+        along[valid] = self.point_dist[best_segment] + best_t * (
+            self.point_dist[following] - self.point_dist[best_segment]
+        )
+        offset[valid] = np.sqrt(distance2[best])
+        return snapped_lat, snapped_lon, along, offset
+
+    def trip_stop_distances(self, trip_idx):
+        """
+        Distance along the shape (meters) of each stop of a trip, computed
+        once and cached.
+
+        When both the stop times and the shape points carry
+        shape_dist_traveled, stops are placed by interpolating it. Otherwise
+        each stop is snapped onto the shape past the previous stop, so stops
+        on the return leg of an out-and-back or a loop keep their order.
+        """
+        distances = self._trip_stop_dist.get(trip_idx)
+        if distances is None:
+            tt = self.timetable
+            stop_times = tt.trip_stop_times(trip_idx)
+            stops = tt.stop_time_stop[stop_times]
+            shape = self.trip_shape[trip_idx]
+            distances = np.zeros(len(stops))
+            if shape >= 0:
+                points = slice(self.shape_point_start[shape], self.shape_point_start[shape + 1])
+                traveled = tt.stop_time_dist[stop_times]
+                point_traveled = self.point_traveled[points]
+                if (
+                    len(point_traveled) > 1
+                    and not np.isnan(traveled).any()
+                    and not np.isnan(point_traveled).any()
+                    and np.all(np.diff(point_traveled) >= 0)
+                ):
+                    distances = np.interp(traveled, point_traveled, self.point_dist[points])
+                else:
+                    along = 0.0
+                    for i, stop in enumerate(stops):
+                        _, _, snapped, offset = self.snap([shape], [tt.stop_lat[stop]], [tt.stop_lon[stop]], [along])
+                        if np.isfinite(offset[0]):
+                            along = max(along, float(snapped[0]))
+                        distances[i] = along
+            with self._lock:
+                self._trip_stop_dist[trip_idx] = distances
+        return distances
+
+    def next_stop(self, trip_idx, distance):
+        """
+        Index (into the trip's stop times) of the next stop after `distance`,
+        or None when the vehicle is past the last stop.
+        """
+        distances = self.trip_stop_distances(trip_idx)
+        position = int(np.searchsorted(distances, distance, side="right"))
+        return position if position < len(distances) else None
+
+
+_shape_index = None
+_shape_index_lock = threading.Lock()
+
+
+def get_shape_index():
+    """
+    Return the process-wide shape index, from the snapshot when available.
+    """
+    global _shape_index
+    if _shape_index is None:
+        with _shape_index_lock:
+            if _shape_index is None:
+                version = get_feed_version() if SNAPSHOT_DIR else None
+                arrays = load_arrays("shapes", ShapeIndex.ARRAY_FIELDS, version)
+                if arrays is not None:
+                    _shape_index = ShapeIndex(arrays, get_timetable())
+                else:
+                    _shape_index = ShapeIndex.from_database(get_timetable())
+                    save_arrays("shapes", _shape_index.to_arrays(), version)
+    return _shape_index
+
+
+# Last snapped (trip index, distance along shape) per vehicle
+_vehicle_progress = {}
+
+
+def snap_vehicles(vehicles):
+    """
+    Snap decoded vehicles (dicts with trip_index, latitude, longitude) in place,
+    adding snapped coordinates, distance along the shape and the next stop.
+    """
+    if not vehicles:
+        return vehicles
+    global _vehicle_progress
+    index = get_shape_index()
+    tt = index.timetable
+    trips = np.array([vehicle["trip_index"] for vehicle in vehicles], dtype=np.int64)
+    shapes = index.trip_shape[trips]
+
+    # Search each vehicle forward from where it was last seen on this trip
+    min_along = np.zeros(len(vehicles))
+    for i, vehicle in enumerate(vehicles):
+        previous = _vehicle_progress.get(vehicle["vehicle_id"])
+        if previous is not None and previous[0] == trips[i]:
+            min_along[i] = max(previous[1] - BACKTRACK_METERS, 0.0)
+    snapped_lat, snapped_lon, along, offset = index.snap(
+        shapes,
+        [vehicle["latitude"] for vehicle in vehicles],
+        [vehicle["longitude"] for vehicle in vehicles],
+        min_along,
+    )
+    # A vehicle found nowhere ahead of its last position (it was misplaced,
+    # or the trip restarted) is searched along the whole shape again
+    retry = np.flatnonzero((min_along > 0) & ~(offset <= MAX_SNAP_METERS))
+    if len(retry):
+        snapped_lat[retry], snapped_lon[retry], along[retry], offset[retry] = index.snap(
+            shapes[retry],
+            [vehicles[i]["latitude"] for i in retry],
+            [vehicles[i]["longitude"] for i in retry],
+        )
+    progress = {}
+
+    for i, vehicle in enumerate(vehicles):
+        vehicle["snapped"] = False
+        vehicle["distance_along_shape"] = None
+        vehicle["next_stop_id"] = None
+        vehicle["next_stop_name"] = None
+        vehicle["next_stop_sequence"] = None
+        if np.isnan(along[i]) or offset[i] > MAX_SNAP_METERS:
+            continue
+        vehicle["raw_latitude"] = vehicle["latitude"]
+        vehicle["raw_longitude"] = vehicle["longitude"]
+        vehicle["latitude"] = float(snapped_lat[i])
+        vehicle["longitude"] = float(snapped_lon[i])
+        vehicle["snapped"] = True
+        vehicle["distance_along_shape"] = round(float(along[i]), 1)
+        progress[vehicle["vehicle_id"]] = (trips[i], float(along[i]))
+        position = index.next_stop(trips[i], along[i])
+        if position is not None:
+            stop_time = tt.trip_stop_time_start[trips[i]] + position
+            stop = tt.stop_time_stop[stop_time]
+            vehicle["next_stop_id"] = str(tt.stop_ids[stop])
+            vehicle["next_stop_name"] = str(tt.stop_names[stop])
+            vehicle["next_stop_sequence"] = int(tt.stop_time_sequence[stop_time])
+
+    # Vehicles not snapped this tick keep their last known progress
+    for vehicle in vehicles:
+        vehicle_id = vehicle["vehicle_id"]
+        if vehicle_id not in progress and vehicle_id in _vehicle_progress:
+            progress[vehicle_id] = _vehicle_progress[vehicle_id]
+    _vehicle_progress = progress
+    return vehicles
@@ -0,0 +1,73 @@
+import argparse
+import os
+
+import numpy as np
+
+import envConfig  # noqa: F401  (loads .env into os.environ)
+
+# Snapshot of derived in-memory structures, written once per feed version.
+# Each structure is a set of numpy arrays saved as .npy files under
+# SNAPSHOT_DIR/<feed version>/; workers memory-map them at boot instead of
+# rebuilding from SQL, so the pages are shared between processes through
+# the OS page cache. A "<prefix>.complete" marker is written last, so a
+# half-written snapshot is never loaded.
+# Reference: https://numpy.org/doc/stable/reference/generated/numpy.load.html
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR")
+
+
+def _snapshot_dir(version):
+    return os.path.join(SNAPSHOT_DIR, version)
+
+
+def load_arrays(prefix, fields, version):
+    """
+    Memory-map the arrays saved under prefix for a feed version.
+    Returns None when snapshots are disabled or not written yet.
+    """
+    if not SNAPSHOT_DIR or version is None:
+        return None
+    directory = _snapshot_dir(version)
+    if not os.path.exists(os.path.join(directory, prefix + ".complete")):
+        return None
+    # Snapshots written before a field was added are rebuilt
+    if not all(os.path.exists(os.path.join(directory, f"{prefix}.{name}.npy")) for name in fields):
+        return None
+    return {
+        name: np.load(os.path.join(directory, f"{prefix}.{name}.npy"), mmap_mode="r")
+        for name in fields
+    }
+
+
+def save_arrays(prefix, arrays, version):
+    """
+    Save arrays under prefix for a feed version (no-op when disabled).
+    """
+    if not SNAPSHOT_DIR or version is None:
+        return
+    directory = _snapshot_dir(version)
+    os.makedirs(directory, exist_ok=True)
+    for name, array in arrays.items():
+        path = os.path.join(directory, f"{prefix}.{name}.npy")
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            np.save(f, np.ascontiguousarray(array), allow_pickle=False)
+        os.replace(temporary, path)
+    with open(os.path.join(directory, prefix + ".complete"), "w") as f:
+        f.write(version)
+
+
+if __name__ == "__main__":
+    from shape_snap import get_shape_index
+    from timetable import get_feed_version, get_timetable
+
+    parser = argparse.ArgumentParser(description="Build the timetable snapshot for the current feed.")
+    parser.parse_args()
+    if not SNAPSHOT_DIR:
+        parser.error("SNAPSHOT_DIR must be set to build a snapshot")
+    if not get_feed_version():
+        parser.error("No feed version recorded; run load_feed_version.py first")
+
+    # Building goes through the regular loaders, which save what they build
+    get_timetable()
+    get_shape_index()
+    print(f"Snapshot for feed version {get_feed_version()} written to {_snapshot_dir(get_feed_version())}")
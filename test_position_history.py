@@ -0,0 +1,59 @@
+import os
+
+import numpy as np
+
+from position_history import COLUMNS, PositionHistory, PositionRecorder, _column_path, day_key
+
+START = 1_700_000_000
+
+
+def _tick(vehicles, offset):
+    return [
+        {
+            "vehicle_id": vehicle,
+            "trip_id": f"trip_{vehicle}",
+            "latitude": offset + i,
+            "longitude": -offset - i,
+            "bearing": 90.0,
+        }
+        for i, vehicle in enumerate(vehicles)
+    ]
+
+
+def test_interrupted_append_does_not_misalign_columns(tmp_path):
+    recorder = PositionRecorder(directory=str(tmp_path))
+    recorder.record(_tick(["A", "B"], 1), START)
+    recorder.close()
+
+    # A tick cut off after the first columns (and halfway through one)
+    day_dir = os.path.join(tmp_path, day_key(START))
+    for name in ("timestamp", "vehicle"):
+        with open(_column_path(day_dir, name), "ab") as f:
+            f.write(np.asarray([START + 10] * 3, dtype=COLUMNS[name]).tobytes())
+    with open(_column_path(day_dir, "trip"), "ab") as f:
+        f.write(b"\x00\x00")
+    with open(os.path.join(day_dir, "vehicles.txt"), "a") as f:
+        f.write("partial")
+
+    recorder = PositionRecorder(directory=str(tmp_path))
+    recorder.record(_tick(["B", "C"], 100), START + 20)
+    recorder.close()
+
+    positions = PositionHistory(str(tmp_path)).positions(START, START + 60)
+    assert [(p["timestamp"], p["vehicle_id"], p["trip_id"], p["latitude"]) for p in positions] == [
+        (START, "A", "trip_A", 1.0),
+        (START, "B", "trip_B", 2.0),
+        (START + 20, "B", "trip_B", 100.0),
+        (START + 20, "C", "trip_C", 101.0),
+    ]
+    sizes = {os.path.getsize(_column_path(day_dir, name)) // COLUMNS[name].itemsize for name in COLUMNS}
+    assert sizes == {4}
+
+
+def test_close_drains_queued_ticks(tmp_path):
+    recorder = PositionRecorder(directory=str(tmp_path))
+    for i in range(20):
+        recorder.record(_tick(["A"], i), START + i)
+    recorder.close()
+
+    assert len(PositionHistory(str(tmp_path)).positions(START, START + 60)) == 20
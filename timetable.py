@@ -0,0 +1,290 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+import envConfig  # noqa: F401  (loads .env into os.environ)
+from database import engine
+from snapshot import SNAPSHOT_DIR, load_arrays, save_arrays
+
+# Compact, array-based copy of the static GTFS timetable.
+# Every table is stored as parallel numpy arrays and every foreign key as an
+# integer index into the referenced table's arrays, so hot paths (routing,
+# ETA propagation, analytics) never touch the ORM.
+# Reference: https://pandas.pydata.org/docs/reference/api/pandas.read_sql.html
+# Reference: https://numpy.org/doc/stable/reference/generated/numpy.searchsorted.html
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+def format_seconds(seconds):
+    """
+    Format seconds since midnight as HH:MM:SS (hours may exceed 24).
+    """
+    return "{:02d}:{:02d}:{:02d}".format(seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+def parse_seconds(value):
+    """
+    Parse HH:MM[:SS] into seconds since midnight (hours may exceed 24).
+    Raises ValueError for malformed or out-of-range values.
+    """
+    parts = [int(part) for part in value.split(":")]
+    if not 2 <= len(parts) <= 3:
+        raise ValueError(f"Invalid time: {value}")
+    while len(parts) < 3:
+        parts.append(0)
+    hours, minutes, seconds = parts
+    if hours < 0 or not 0 <= minutes < 60 or not 0 <= seconds < 60:
+        raise ValueError(f"Invalid time: {value}")
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def _str_array(series):
+    """
+    Convert a pandas Series to a fixed-width unicode array ('' for missing).
+    """
+    if len(series) == 0:
+        return np.array([], dtype="U1")
+    return series.fillna("").astype(str).to_numpy(dtype=str)
+
+
+def _time_to_seconds(series):
+    """
+    Convert time-of-day values (datetime.time or 'HH:MM:SS') to seconds.
+    """
+    if len(series) == 0:
+        return np.array([], dtype=np.int32)
+    return pd.to_timedelta(series.astype(str)).dt.total_seconds().to_numpy().astype(np.int32)
+
+
+def _date_to_int(series):
+    """
+    Convert dates to YYYYMMDD integers for cheap comparisons.
+    """
+    if len(series) == 0:
+        return np.array([], dtype=np.int32)
+    dates = pd.to_datetime(series)
+    return (dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day).to_numpy().astype(np.int32)
+
+
+def _index_of(values, ids):
+    """
+    Map each value to its position in ids (-1 when not found).
+    """
+    lookup = pd.Index(ids)
+    return lookup.get_indexer(pd.Series(values).fillna("").astype(str)).astype(np.int32)
+
+
+class Timetable:
+    """
+    Static GTFS tables held as numpy arrays.
+
+    Stop times are sorted by (trip, stop_sequence); the stop times of trip i
+    are the slice trip_stop_time_start[i]:trip_stop_time_start[i + 1].
+    Per-stop timetables are kept as an index: stop_departure_order lists stop
+    time positions sorted by (stop, departure), delimited per stop by
+    stop_departure_start.
+    """
+
+    ARRAY_FIELDS = (
+        "stop_ids", "stop_names", "stop_lat", "stop_lon",
+        "route_ids", "route_short_names", "route_colors", "route_agency_ids",
+        "service_ids", "service_weekdays", "service_start_dates", "service_end_dates",
+        "trip_ids", "trip_route", "trip_service", "trip_shape_ids",
+        "trip_direction", "trip_block_ids", "trip_headsigns",
+        "stop_time_trip", "stop_time_stop", "stop_time_sequence",
+        "stop_time_arrival", "stop_time_departure", "stop_time_dist",
+        "trip_stop_time_start", "stop_departure_order", "stop_departure_start",
+    )
+
+    def __init__(self, arrays):
+        for name in self.ARRAY_FIELDS:
+            setattr(self, name, arrays[name])
+
+        # Id -> index lookups for request handlers
+        self.stop_index = {stop_id: i for i, stop_id in enumerate(self.stop_ids.tolist())}
+        self.route_index = {route_id: i for i, route_id in enumerate(self.route_ids.tolist())}
+        self.trip_index = {trip_id: i for i, trip_id in enumerate(self.trip_ids.tolist())}
+        self.service_index = {service_id: i for i, service_id in enumerate(self.service_ids.tolist())}
+
+    @classmethod
+    def from_database(cls, bind=engine):
+        """
+        Read the static tables once and build the array representation.
+        """
+        stops = pd.read_sql("SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops", bind)
+        routes = pd.read_sql(
+            "SELECT route_id, route_short_name, route_color, agency_id FROM routes", bind
+        )
+        calendar = pd.read_sql(
+            "SELECT service_id, monday, tuesday, wednesday, thursday, friday, saturday, sunday, "
+            "start_date, end_date FROM calendar",
+            bind,
+        )
+        trips = pd.read_sql(
+            "SELECT trip_id, route_id, service_id, shape_id, direction_id, block_id, trip_headsign "
+            "FROM trips",
+            bind,
+        )
+        stop_times = pd.read_sql(
+            "SELECT trip_id, stop_id, stop_sequence, arrival_time, departure_time, shape_dist_traveled "
+            "FROM stop_times",
+            bind,
+        )
+        return cls(cls._build_arrays(stops, routes, calendar, trips, stop_times))
+
+    @staticmethod
+    def _build_arrays(stops, routes, calendar, trips, stop_times):
+        arrays = {}
+
+        arrays["stop_ids"] = _str_array(stops["stop_id"])
+        arrays["stop_names"] = _str_array(stops["stop_name"])
+        arrays["stop_lat"] = pd.to_numeric(stops["stop_lat"], errors="coerce").to_numpy(dtype=np.float64)
+        arrays["stop_lon"] = pd.to_numeric(stops["stop_lon"], errors="coerce").to_numpy(dtype=np.float64)
+
+        arrays["route_ids"] = _str_array(routes["route_id"])
+        arrays["route_short_names"] = _str_array(routes["route_short_name"])
+        arrays["route_colors"] = _str_array(routes["route_color"])
+        arrays["route_agency_ids"] = _str_array(routes["agency_id"].astype("Int64").astype("string"))
+
+        arrays["service_ids"] = _str_array(calendar["service_id"])
+        arrays["service_weekdays"] = calendar[WEEKDAYS].fillna(False).to_numpy(dtype=bool).reshape(-1, 7)
+        arrays["service_start_dates"] = _date_to_int(calendar["start_date"])
+        arrays["service_end_dates"] = _date_to_int(calendar["end_date"])
+
+        trips = trips.assign(
+            route_idx=_index_of(trips["route_id"], arrays["route_ids"]),
+            service_idx=_index_of(trips["service_id"], arrays["service_ids"]),
+        )
+        trips = trips[trips["route_idx"] >= 0].reset_index(drop=True)
+        arrays["trip_ids"] = _str_array(trips["trip_id"])
+        arrays["trip_route"] = trips["route_idx"].to_numpy(dtype=np.int32)
+        arrays["trip_service"] = trips["service_idx"].to_numpy(dtype=np.int32)
+        arrays["trip_shape_ids"] = _str_array(trips["shape_id"])
+        arrays["trip_direction"] = (
+            pd.to_numeric(trips["direction_id"], errors="coerce").fillna(-1).to_numpy().astype(np.int8)
+        )
+        arrays["trip_block_ids"] = _str_array(trips["block_id"])
+        arrays["trip_headsigns"] = _str_array(trips["trip_headsign"])
+
+        stop_times = stop_times.assign(
+            trip_idx=_index_of(stop_times["trip_id"], arrays["trip_ids"]),
+            stop_idx=_index_of(stop_times["stop_id"], arrays["stop_ids"]),
+        )
+        stop_times = stop_times[(stop_times["trip_idx"] >= 0) & (stop_times["stop_idx"] >= 0)]
+        stop_times = stop_times.sort_values(["trip_idx", "stop_sequence"], kind="mergesort")
+        arrays["stop_time_trip"] = stop_times["trip_idx"].to_numpy(dtype=np.int32)
+        arrays["stop_time_stop"] = stop_times["stop_idx"].to_numpy(dtype=np.int32)
+        arrays["stop_time_sequence"] = stop_times["stop_sequence"].to_numpy(dtype=np.int32)
+        arrays["stop_time_arrival"] = _time_to_seconds(stop_times["arrival_time"])
+        arrays["stop_time_departure"] = _time_to_seconds(stop_times["departure_time"])
+        arrays["stop_time_dist"] = stop_times["shape_dist_traveled"].to_numpy(dtype=np.float64, na_value=np.nan)
+        arrays["trip_stop_time_start"] = np.searchsorted(
+            arrays["stop_time_trip"], np.arange(len(arrays["trip_ids"]) + 1)
+        ).astype(np.int64)
+
+        # Per-stop timetables, ordered by departure
+        arrays["stop_departure_order"] = np.lexsort(
+            (arrays["stop_time_departure"], arrays["stop_time_stop"])
+        ).astype(np.int64)
+        arrays["stop_departure_start"] = np.searchsorted(
+            arrays["stop_time_stop"][arrays["stop_departure_order"]], np.arange(len(arrays["stop_ids"]) + 1)
+        ).astype(np.int64)
+
+        return arrays
+
+    def to_arrays(self):
+        return {name: getattr(self, name) for name in self.ARRAY_FIELDS}
+
+    def trip_stop_times(self, trip_idx):
+        """
+        Return the slice of the stop time arrays belonging to a trip.
+        """
+        return slice(self.trip_stop_time_start[trip_idx], self.trip_stop_time_start[trip_idx + 1])
+
+    def stop_departures(self, stop_idx):
+        """
+        Stop time positions serving a stop, ordered by departure.
+        """
+        return self.stop_departure_order[self.stop_departure_start[stop_idx]:self.stop_departure_start[stop_idx + 1]]
+
+    def active_service_mask(self, service_date):
+        """
+        Boolean mask over services running on the given date.
+        """
+        day = service_date.year * 10000 + service_date.month * 100 + service_date.day
+        return (
+            self.service_weekdays[:, service_date.weekday()]
+            & (self.service_start_dates <= day)
+            & (self.service_end_dates >= day)
+        )
+
+    def active_trip_mask(self, service_date):
+        """
+        Boolean mask over trips whose service runs on the given date.
+        """
+        services = self.active_service_mask(service_date)
+        if len(services) == 0:
+            return np.zeros(len(self.trip_ids), dtype=bool)
+        return (self.trip_service >= 0) & services[np.maximum(self.trip_service, 0)]
+
+
+def feed_version(bind=engine):
+    """
+    Identifier of the static feed currently loaded, used to key derived caches.
+
+    GTFS_FEED_VERSION wins when set; otherwise the version recorded by
+    load_feed_version.py (a hash of the imported files) is used. Returns None
+    while no version is recorded, e.g. during a re-import, which disables the
+    on-disk caches keyed by it.
+    """
+    configured = os.getenv("GTFS_FEED_VERSION")
+    if configured:
+        return configured
+    try:
+        with bind.connect() as connection:
+            return connection.execute(text("SELECT version FROM feed_version")).scalar()
+    except SQLAlchemyError:
+        # Tables created before feed versions were recorded
+        return None
+
+
+_feed_version = None
+_feed_version_loaded = False
+_timetable = None
+_timetable_lock = threading.Lock()
+
+
+def get_feed_version():
+    """
+    Feed version of this process, looked up once.
+    """
+    global _feed_version, _feed_version_loaded
+    if not _feed_version_loaded:
+        _feed_version = feed_version()
+        _feed_version_loaded = True
+    return _feed_version
+
+
+def get_timetable():
+    """
+    Return the process-wide timetable: memory-mapped from the snapshot of the
+    current feed version when one exists, otherwise built from the database
+    (and snapshotted for the next worker).
+    """
+    global _timetable
+    if _timetable is None:
+        with _timetable_lock:
+            if _timetable is None:
+                version = get_feed_version() if SNAPSHOT_DIR else None
+                arrays = load_arrays("timetable", Timetable.ARRAY_FIELDS, version)
+                if arrays is not None:
+                    _timetable = Timetable(arrays)
+                else:
+                    _timetable = Timetable.from_database()
+                    save_arrays("timetable", _timetable.to_arrays(), version)
+    return _timetable
@@ -0,0 +1,423 @@
+import argparse
+import math
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import envConfig  # noqa: F401  (loads .env into os.environ)
+from shape_snap import get_shape_index
+from timetable import get_feed_version, get_timetable
+
+# Mapbox vector tiles for stops and route shapes.
+# Stops and shape points are projected to Web Mercator once; a tile request
+# only culls by bounding box, clips, simplifies and encodes what falls in
+# the viewport. Rendered tiles are kept in an in-memory LRU and, when
+# TILE_CACHE_DIR is set, on disk under <dir>/<feed version>/z/x/y.mvt.
+# Reference: https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+# Reference: https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
+
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+# Simplification tolerance in tile units (4096 / 256 = one screen pixel)
+SIMPLIFY_TOLERANCE = 16
+STOPS_MIN_ZOOM = int(os.getenv("TILE_STOPS_MIN_ZOOM", "13"))
+MAX_ZOOM = 18
+TILE_CACHE_DIR = os.getenv("TILE_CACHE_DIR")
+TILE_CACHE_SIZE = int(os.getenv("TILE_CACHE_SIZE", "4096"))
+
+GEOMETRY_POINT = 1
+GEOMETRY_LINESTRING = 2
+
+
+def mercator(latitude, longitude):
+    """
+    Project lat/lon (degrees) to Web Mercator in the unit square (y down).
+    """
+    latitude = np.clip(np.asarray(latitude, dtype=np.float64), -85.0511, 85.0511)
+    longitude = np.asarray(longitude, dtype=np.float64)
+    x = (longitude + 180.0) / 360.0
+    y = (1.0 - np.log(np.tan(np.radians(latitude)) + 1.0 / np.cos(np.radians(latitude))) / math.pi) / 2.0
+    return x, y
+
+
+# --- Minimal protobuf encoding of the vector tile schema ---
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _field_varint(field, value):
+    return _varint(field << 3) + _varint(value)
+
+
+def _field_bytes(field, payload):
+    return _varint((field << 3) | 2) + _varint(len(payload)) + payload
+
+
+def _field_packed(field, values):
+    return _field_bytes(field, b"".join(_varint(value) for value in values))
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 31)
+
+
+def _command(command_id, count):
+    return (command_id & 0x7) | (count << 3)
+
+
+def _encode_geometry(parts, geometry_type):
+    """
+    Encode integer tile coordinates as MVT geometry commands.
+    """
+    commands = []
+    cursor_x = cursor_y = 0
+    for part in parts:
+        commands.append(_command(1, 1))
+        commands.append(_zigzag(part[0][0] - cursor_x))
+        commands.append(_zigzag(part[0][1] - cursor_y))
+        cursor_x, cursor_y = part[0]
+        if geometry_type == GEOMETRY_LINESTRING:
+            commands.append(_command(2, len(part) - 1))
+            for x, y in part[1:]:
+                commands.append(_zigzag(x - cursor_x))
+                commands.append(_zigzag(y - cursor_y))
+                cursor_x, cursor_y = x, y
+    return commands
+
+
+def encode_layer(name, features):
+    """
+    Encode one layer. features are (id, properties, geometry_type, parts).
+    """
+    keys, values = [], []
+    key_index, value_index = {}, {}
+    encoded_features = []
+    for feature_id, properties, geometry_type, parts in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None or value == "":
+                continue
+            if key not in key_index:
+                key_index[key] = len(keys)
+                keys.append(key)
+            value = str(value)
+            if value not in value_index:
+                value_index[value] = len(values)
+                values.append(value)
+            tags.extend((key_index[key], value_index[value]))
+        encoded_features.append(
+            _field_bytes(
+                2,
+                _field_varint(1, feature_id)
+                + _field_packed(2, tags)
+                + _field_varint(3, geometry_type)
+                + _field_packed(4, _encode_geometry(parts, geometry_type)),
+            )
+        )
+
+    layer = _field_varint(15, 2) + _field_bytes(1, name.encode())
+    layer += b"".join(encoded_features)
+    layer += b"".join(_field_bytes(3, key.encode()) for key in keys)
+    layer += b"".join(_field_bytes(4, _field_bytes(1, value.encode())) for value in values)
+    layer += _field_varint(5, TILE_EXTENT)
+    return _field_bytes(3, layer)
+
+
+# --- Geometry helpers in tile coordinates ---
+
+def simplify(points, tolerance):
+    """
+    Douglas-Peucker simplification of an (n, 2) array.
+    """
+    if len(points) < 3:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        segment = end - start
+        inner = points[first + 1:last]
+        length = math.hypot(segment[0], segment[1])
+        if length == 0:
+            distances = np.hypot(inner[:, 0] - start[0], inner[:, 1] - start[1])
+        else:
+            distances = np.abs(segment[0] * (inner[:, 1] - start[1]) - segment[1] * (inner[:, 0] - start[0])) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return points[keep]
+
+
+def clip_line(points, minimum, maximum):
+    """
+    Clip a polyline to a square, returning the parts that fall inside
+    (Liang-Barsky per segment).
+    """
+    parts = []
+    current = []
+    for (x0, y0), (x1, y1) in zip(points[:-1], points[1:]):
+        t0, t1 = 0.0, 1.0
+        dx, dy = x1 - x0, y1 - y0
+        visible = True
+        for p, q in ((-dx, x0 - minimum), (dx, maximum - x0), (-dy, y0 - minimum), (dy, maximum - y0)):
+            if p == 0:
+                if q < 0:
+                    visible = False
+                    break
+            else:
+                t = q / p
+                if p < 0:
+                    t0 = max(t0, t)
+                else:
+                    t1 = min(t1, t)
+        if not visible or t0 > t1:
+            if len(current) > 1:
+                parts.append(current)
+            current = []
+            continue
+        start = (x0 + t0 * dx, y0 + t0 * dy)
+        end = (x0 + t1 * dx, y0 + t1 * dy)
+        if not current:
+            current = [start]
+        current.append(end)
+        if t1 < 1.0:
+            parts.append(current)
+            current = []
+    if len(current) > 1:
+        parts.append(current)
+    return parts
+
+
+def _quantize(part):
+    """
+    Round to integer tile units, dropping repeated points.
+    """
+    quantized = []
+    for x, y in part:
+        point = (int(round(x)), int(round(y)))
+        if not quantized or quantized[-1] != point:
+            quantized.append(point)
+    return quantized if len(quantized) > 1 else None
+
+
+class TileRenderer:
+    """
+    Renders stop and shape tiles for one feed version.
+    """
+
+    def __init__(self, timetable, shape_index, version):
+        self.version = version
+        # Without a recorded feed version tiles could outlive the data they show
+        self.disk_cache = bool(TILE_CACHE_DIR and version)
+        self.timetable = timetable
+        self.shape_index = shape_index
+
+        self.stop_x, self.stop_y = mercator(timetable.stop_lat, timetable.stop_lon)
+        self.point_x, self.point_y = mercator(shape_index.point_lat, shape_index.point_lon)
+
+        # Route drawn for each shape: the route of any trip using it
+        n_shapes = len(shape_index.shape_ids)
+        self.shape_route = np.full(n_shapes, -1, dtype=np.int32)
+        used = shape_index.trip_shape >= 0
+        self.shape_route[shape_index.trip_shape[used]] = timetable.trip_route[used]
+
+        # Per-shape bounding boxes for culling
+        starts = shape_index.shape_point_start
+        self.shape_bounds = np.full((n_shapes, 4), np.nan)
+        non_empty = np.flatnonzero(starts[1:] > starts[:-1])
+        if len(non_empty):
+            for bound, values, reducer in (
+                (0, self.point_x, np.minimum), (1, self.point_y, np.minimum),
+                (2, self.point_x, np.maximum), (3, self.point_y, np.maximum),
+            ):
+                self.shape_bounds[non_empty, bound] = reducer.reduceat(values, starts[non_empty])
+
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _tile_frame(self, z, x, y):
+        """
+        Unit-square bounds of a tile (with buffer) and the unit -> tile scale.
+        """
+        scale = (1 << z) * TILE_EXTENT
+        buffer = TILE_BUFFER / scale
+        left, top = x / (1 << z), y / (1 << z)
+        right, bottom = (x + 1) / (1 << z), (y + 1) / (1 << z)
+        return (left - buffer, top - buffer, right + buffer, bottom + buffer), (left, top), scale
+
+    def render(self, z, x, y):
+        tt = self.timetable
+        (min_x, min_y, max_x, max_y), (left, top), scale = self._tile_frame(z, x, y)
+        layers = b""
+
+        shapes = np.flatnonzero(
+            (self.shape_bounds[:, 0] <= max_x) & (self.shape_bounds[:, 2] >= min_x)
+            & (self.shape_bounds[:, 1] <= max_y) & (self.shape_bounds[:, 3] >= min_y)
+        )
+        shape_features = []
+        starts = self.shape_index.shape_point_start
+        for shape in shapes.tolist():
+            points = np.column_stack(
+                (
+                    (self.point_x[starts[shape]:starts[shape + 1]] - left) * scale,
+                    (self.point_y[starts[shape]:starts[shape + 1]] - top) * scale,
+                )
+            )
+            points = simplify(points, SIMPLIFY_TOLERANCE)
+            parts = [
+                quantized
+                for part in clip_line(points.tolist(), -TILE_BUFFER, TILE_EXTENT + TILE_BUFFER)
+                for quantized in [_quantize(part)]
+                if quantized
+            ]
+            if not parts:
+                continue
+            route = self.shape_route[shape]
+            properties = {"shape_id": str(self.shape_index.shape_ids[shape])}
+            if route >= 0:
+                color = str(tt.route_colors[route])
+                properties.update(
+                    route_id=str(tt.route_ids[route]),
+                    route_short_name=str(tt.route_short_names[route]),
+                    route_color="#" + color if color else None,
+                )
+            shape_features.append((shape + 1, properties, GEOMETRY_LINESTRING, parts))
+        if shape_features:
+            layers += encode_layer("shapes", shape_features)
+
+        if z >= STOPS_MIN_ZOOM:
+            stops = np.flatnonzero(
+                (self.stop_x >= min_x) & (self.stop_x <= max_x)
+                & (self.stop_y >= min_y) & (self.stop_y <= max_y)
+            )
+            stop_features = [
+                (
+                    stop + 1,
+                    {"stop_id": str(tt.stop_ids[stop]), "stop_name": str(tt.stop_names[stop])},
+                    GEOMETRY_POINT,
+                    [[(
+                        int(round((self.stop_x[stop] - left) * scale)),
+                        int(round((self.stop_y[stop] - top) * scale)),
+                    )]],
+                )
+                for stop in stops.tolist()
+            ]
+            if stop_features:
+                layers += encode_layer("stops", stop_features)
+
+        return layers
+
+    def _disk_path(self, z, x, y):
+        return os.path.join(TILE_CACHE_DIR, self.version, str(z), str(x), f"{y}.mvt")
+
+    def _write_disk(self, z, x, y, tile):
+        path = self._disk_path(z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(tile)
+        os.replace(temporary, path)
+
+    def tile(self, z, x, y):
+        """
+        Return an encoded tile, from the LRU, the disk cache or freshly rendered.
+        """
+        key = (z, x, y)
+        with self._lock:
+            tile = self._lru.get(key)
+            if tile is not None:
+                self._lru.move_to_end(key)
+                return tile
+
+        tile = None
+        if self.disk_cache:
+            try:
+                with open(self._disk_path(z, x, y), "rb") as f:
+                    tile = f.read()
+            except FileNotFoundError:
+                pass
+        if tile is None:
+            tile = self.render(z, x, y)
+            if self.disk_cache:
+                self._write_disk(z, x, y, tile)
+
+        with self._lock:
+            self._lru[key] = tile
+            while len(self._lru) > TILE_CACHE_SIZE:
+                self._lru.popitem(last=False)
+        return tile
+
+    def network_tiles(self, z):
+        """
+        Tiles at zoom z covering the bounding box of all stops and shapes.
+        """
+        xs = np.concatenate((self.stop_x, self.point_x))
+        ys = np.concatenate((self.stop_y, self.point_y))
+        if len(xs) == 0:
+            return
+        n = 1 << z
+        first_x, last_x = int(np.nanmin(xs) * n), min(int(np.nanmax(xs) * n), n - 1)
+        first_y, last_y = int(np.nanmin(ys) * n), min(int(np.nanmax(ys) * n), n - 1)
+        for x in range(first_x, last_x + 1):
+            for y in range(first_y, last_y + 1):
+                yield x, y
+
+    def prerender(self, min_zoom, max_zoom):
+        """
+        Render the tile pyramid over the network into the disk cache.
+        """
+        rendered = 0
+        for z in range(min_zoom, max_zoom + 1):
+            for x, y in self.network_tiles(z):
+                tile = self.render(z, x, y)
+                if self.disk_cache:
+                    self._write_disk(z, x, y, tile)
+                rendered += 1
+        return rendered
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_tile_renderer():
+    """
+    Return the process-wide tile renderer for the current feed version.
+    """
+    global _renderer
+    if _renderer is None:
+        with _renderer_lock:
+            if _renderer is None:
+                _renderer = TileRenderer(get_timetable(), get_shape_index(), get_feed_version())
+    return _renderer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-render vector tiles into TILE_CACHE_DIR.")
+    parser.add_argument("--min-zoom", type=int, default=10)
+    parser.add_argument("--max-zoom", type=int, default=15)
+    args = parser.parse_args()
+    if not TILE_CACHE_DIR:
+        parser.error("TILE_CACHE_DIR must be set to pre-render tiles")
+    if not get_feed_version():
+        parser.error("No feed version recorded; run load_feed_version.py first")
+    count = get_tile_renderer().prerender(args.min_zoom, args.max_zoom)
+    print(f"Rendered {count} tiles.")